@@ -1,136 +1,468 @@
 import streamlit as st
 from streamlit_option_menu import option_menu
 from openai import OpenAI
-import base64
 from datetime import datetime
-import sqlite3
-import pandas as pd
-
-# Initialize OpenAI client
+import json
+import logging
+import os
+import time
+import uuid
+from PIL import UnidentifiedImageError
+from concurrent.futures import ThreadPoolExecutor, wait
+from images import DETAIL_TIERS, ImageCache, prepare_images
+from db import Database, ResponseCache, normalize_query
+from fetch import FetchError, ImageFetcher, parse_urls
+from plan_cache import PlanCache
+from plot_worker import PlotWorkerPool, RenderError
+from floorplan import SpecError, canonical_spec, generate_floorplan_spec, generate_matplotlib_code, parse_spec
+from context import clean_title, conversation_digest, history_messages, provisional_title
+from vision import MODEL, EmptyAnswer, ask
+from metrics import QUANTILES, MetricsStore, Trace, record_call
+from scheduler import BACKGROUND, Scheduler, request_tokens
+from similarity import DEFAULT_MAX_DISTANCE, DEFAULT_THRESHOLD, SimilarityIndex
+from image_store import ImageStore
+
+# OpenAI API key
 apiKey = ''
-client = OpenAI(api_key=apiKey)
+
+# Upper bound on the memory held by encoded images shared across sessions
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Number of threads used to preprocess attached images
+IMAGE_WORKERS = 4
+# Limits for downloading pasted image links, and where downloads are cached
+IMAGE_FETCH_MAX_BYTES = 20 * 1024 * 1024
+IMAGE_FETCH_TIMEOUT = 15
+IMAGE_FETCH_CACHE_DIR = '.image_cache'
+IMAGE_FETCH_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Age after which stored images that no saved chat refers to are deleted, and the longest a save waits
+# for the images of its chat to be stored
+IMAGE_ORPHAN_TTL = 24 * 60 * 60
+IMAGE_STORE_TIMEOUT = 30
+# Lifetime and size limit of the persistent response cache
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+# Messages per page in History and Prev Chats, and characters of a response shown before expanding it
+PAGE_SIZE = 20
+PREVIEW_CHARS = 500
+# Where generated floorplan code and renders are cached, and how much disk they may use
+PLAN_CACHE_DIR = '.plan_cache'
+PLAN_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Worker processes that run generated plotting code, with the time and memory each job may use
+PLOT_WORKERS = 2
+PLOT_TIMEOUT = 30
+PLOT_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+# Token budget for the earlier turns sent along with each query
+CONTEXT_TOKEN_BUDGET = 3000
+# Rate limits of the OpenAI account, shared by all sessions, and retries of rate-limited or failed requests
+API_RPM = 500
+API_TPM = 30000
+API_RETRIES = 4
+
+# Lowest text similarity, from 0 to 1, at which an earlier answer is offered for a new query, and the most bits
+# each of its images' perceptual hashes may differ by
+SIMILARITY_THRESHOLD = DEFAULT_THRESHOLD
+IMAGE_HASH_MAX_DISTANCE = DEFAULT_MAX_DISTANCE
+
+# Directory of the markdown shown on the Guide and Generate pages, and the sidebar logo. The logo URL is passed
+# to the page as is, so the browser loads it and the server never waits on a download before drawing the page
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+LOGO_URL = "https://image.pitchbook.com/Tf5tfYnTZayaB4Yx7cSABAXNnaR1638562088465_200x200"
+
+# Function to create an empty chat history; "images" holds the image hashes of each turn
+def new_chat_history():
+    return {"ques": [], "ans": [], "timestamp": [], "images": []}
 
 # Initialize session state if not exists
 if 'chatHistory' not in st.session_state:
-    st.session_state.chatHistory = {"ques": [], "ans": [], "timestamp": []}
-
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
-
-def output(query, cho, paths):
+    st.session_state.chatHistory = new_chat_history()
+st.session_state.chatHistory.setdefault("images", [])
+# Identifies this session's requests in the metrics until they are saved as a chat
+st.session_state.setdefault("session_id", uuid.uuid4().hex)
+
+# OpenAI client shared by all sessions, so reruns reuse it and its open connections.
+# Retries are left to the scheduler, which knows about the other requests
+@st.cache_resource
+def get_client():
+    return OpenAI(api_key=apiKey, max_retries=0)
+
+# Rate limiting, retries and coalescing of identical requests for every API call the app makes
+@st.cache_resource
+def get_scheduler():
+    return Scheduler(API_RPM, API_TPM, API_RETRIES)
+
+# Image cache shared by all sessions, so reruns reuse already encoded images
+@st.cache_resource
+def get_image_cache():
+    return ImageCache(IMAGE_CACHE_MAX_BYTES)
+
+# Thread pool for work the user should not wait on, such as naming saved chats
+@st.cache_resource
+def get_background_pool():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")
+
+# Thread pool shared by all sessions for decoding and downscaling uploads
+@st.cache_resource
+def get_image_pool():
+    return ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# Downloader for pasted image links, shared by all sessions so connections are reused
+@st.cache_resource
+def get_image_fetcher():
+    return ImageFetcher(IMAGE_FETCH_CACHE_DIR, IMAGE_FETCH_MAX_BYTES, IMAGE_FETCH_TIMEOUT,
+                        max_cache_bytes=IMAGE_FETCH_CACHE_MAX_BYTES)
+
+# Disk cache of generated floorplan code and rendered figures, shared by all sessions
+@st.cache_resource
+def get_plan_cache():
+    return PlanCache(PLAN_CACHE_DIR, PLAN_CACHE_MAX_BYTES)
+
+# Pre-started worker processes for rendering floorplans, shared by all sessions
+@st.cache_resource
+def get_plot_pool():
+    return PlotWorkerPool(PLOT_WORKERS, PLOT_TIMEOUT, PLOT_MEMORY_LIMIT)
+
+# Data-access layer for history.db, shared by all sessions
+@st.cache_resource
+def get_db():
+    return Database('history.db')
+
+# Cache of temperature=0 responses stored in history.db and shared by all sessions
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(get_db(), RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+
+# Timing and token usage records stored in history.db
+@st.cache_resource
+def get_metrics():
+    return MetricsStore(get_db())
+
+# Vectors of answered queries, loaded from history.db once per server and shared by all sessions
+@st.cache_resource
+def get_similarity_index():
+    return SimilarityIndex(get_db())
+
+# Original images of queries stored in history.db; images left over from chats never saved are collected at startup
+@st.cache_resource
+def get_image_store():
+    store = ImageStore(get_db(), IMAGE_ORPHAN_TTL)
+    store.collect()
+    return store
+
+# Thumbnails never change for a content hash, so each one is read from the database once
+@st.cache_data(max_entries=500, show_spinner=False)
+def load_thumbnail(digest):
+    return get_image_store().thumbnail(digest)
+
+# Static markdown, read from disk once per server
+@st.cache_resource
+def load_asset(name):
+    with open(os.path.join(ASSETS_DIR, name), encoding="utf-8") as asset:
+        return asset.read()
+
+# Function to read and prepare the images attached to a query, timing the download and the encoding,
+# and keep the originals so a saved chat can show them
+def load_images(cho, paths, detail="auto", trace=None):
+    trace = trace or Trace("images")
     if cho == "Attach image":
-        base64_images = [encode_image(path.name) for path in paths]
-        image_urls = [f"data:image/png;base64,{base64_img}" for base64_img in base64_images]
-        
-        messages = [
-            {"role": "user", "content": [
-                {"type": "text", "text": query}
-            ] + [
-                {"type": "image_url", "image_url": {"url": url}}
-                for url in image_urls
-            ]}
-        ]
-        
-        response = client.chat.completions.create(
-            model='gpt-4o',
-            messages=messages,
-            temperature=0.0,
+        # Read the uploads straight from their in-memory buffers
+        blobs = [path.getvalue() for path in paths]
+    elif cho == "Paste the image link":
+        with trace.span("fetch"):
+            blobs = get_image_fetcher().fetch_all(parse_urls(paths))
+    else:
+        return []
+    with trace.span("encode"):
+        try:
+            images = prepare_images(blobs, detail, get_image_cache(), get_image_pool())
+        except (UnidentifiedImageError, OSError) as e:
+            # A link to a web page, or a damaged file, is reported like a failed download
+            raise FetchError(f"Could not read an attached image: {e}") from e
+    # Store the originals in the background, off the query's critical path; saving the chat waits for them
+    writes = st.session_state.setdefault("image_writes", [])
+    writes[:] = [write for write in writes if not write.done()]
+    writes.append(get_background_pool().submit(store_images, get_image_store(), images, blobs))
+    return images
+
+# Function to store the original images of a query, run in the background
+def store_images(store, images, blobs):
+    try:
+        store.put_all(images, blobs)
+    except Exception:
+        logging.getLogger(__name__).exception("Could not store %d images", len(images))
+
+# Function to pick the earlier turns of the conversation sent along with a query, within the context token budget
+def earlier_turns(history, images):
+    if not history:
+        return []
+    return history_messages(history["ques"], history["ans"], history["images"], [image.digest for image in images],
+                            CONTEXT_TOKEN_BUDGET)
+
+# Function to answer a query about the prepared images, continuing the conversation in history if given
+def output(query, images, detail="auto", stream=False, use_cache=True, history=None, trace=None):
+    if images:
+        earlier = earlier_turns(history, images)
+        return ask(get_client(), get_response_cache(), query, images, detail, stream, use_cache, earlier, trace=trace,
+                   scheduler=get_scheduler())
+
+# Function to show a page of (id, question, response preview, response length, timestamp) rows,
+# loading the full response of a message only when the user asks for it.
+# images maps message ids to their stored (digest, width, height) images, shown as thumbnails
+def render_messages(rows, load_response, key, images=None):
+    expanded = st.session_state.setdefault(f"{key}_expanded", set())
+    for message_id, question, preview, length, timestamp in rows:
+        st.markdown(f"**You :** {question}")
+        st.caption(timestamp)
+        if images and message_id in images:
+            render_images(images[message_id], key, message_id)
+        if length <= len(preview):
+            st.info(preview)
+        elif message_id in expanded:
+            st.info(load_response(message_id))
+        else:
+            st.info(preview + "…")
+            st.button("Show full response", key=f"{key}_more_{message_id}", on_click=expanded.add, args=(message_id,))
+
+# Function to show the thumbnails of a message's images, reading the full images only when the user asks for them
+def render_images(images, key, message_id):
+    full = st.session_state.setdefault(f"{key}_full_images", set())
+    if message_id in full:
+        for digest, width, height in images:
+            stored = get_image_store().image(digest)
+            if stored is not None:
+                st.image(stored[1], caption=f"{width}×{height}")
+        st.button("Hide images", key=f"{key}_hide_{message_id}", on_click=full.discard, args=(message_id,))
+        return
+    for column, (digest, width, height) in zip(st.columns(4), images[:4]):
+        thumbnail = load_thumbnail(digest)
+        if thumbnail is not None:
+            column.image(thumbnail, caption=f"{width}×{height}")
+    label = "Show full images" if len(images) <= 4 else f"Show all {len(images)} images"
+    st.button(label, key=f"{key}_show_{message_id}", on_click=full.add, args=(message_id,))
+
+# Function to open a saved chat in Prev Chats, starting at the page that holds message_id if given
+def open_chat(chat_id, message_id=None):
+    cursor = get_db().message_cursor(message_id) if message_id is not None else None
+    st.session_state.open_chat = chat_id
+    st.session_state.chat_cursors = [None] if cursor is None else [None, cursor]
+    st.session_state.chat_expanded = set()
+    st.session_state.chat_full_images = set()
+
+# Function to jump from a search result to its chat
+def open_search_result(chat, message_id):
+    st.session_state.prev_chat_select = chat
+    open_chat(chat[0], message_id)
+
+# Function to show Previous/Next buttons over a stack of page cursors kept in session state
+def render_pager(key, next_cursor):
+    cursors = st.session_state[f"{key}_cursors"]
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    with prev_col:
+        st.button("Previous", key=f"{key}_prev", disabled=len(cursors) == 1, on_click=cursors.pop)
+    with page_col:
+        st.caption(f"Page {len(cursors)}")
+    with next_col:
+        st.button("Next", key=f"{key}_next", disabled=next_cursor is None, on_click=cursors.append, args=(next_cursor,))
+
+# Function to generate a title, as background work that waits for interactive requests
+def generate_title(prompt, trace=None):
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant. You are going to choose an appropriate title for the given string like chatgpt chooses the chat title. Reply with the title only."}, 
+        {"role": "user", "content": f"give me a suitable title for a chat with these questions:\n{prompt}"}  
+    ]
+    
+    def request():
+        started = time.perf_counter()
+        completion = get_client().chat.completions.create(
+          model="gpt-4o",
+          messages=messages
         )
-        
-        return response.choices[0].message.content
-
-# Function to get table names from the database
-def get_table_names():
-    conn = sqlite3.connect('history.db')
-    c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = c.fetchall()
-    conn.close()
-    return [table[0] for table in tables]
-
-# Function to fetch data from the selected table
-def fetch_table_data(table_name):
-    conn = sqlite3.connect('history.db')
-    c = conn.cursor()
-    c.execute(f"SELECT * FROM {table_name}")
-    data = c.fetchall()
-    conn.close()
-    return data
-
-# Function to generate a title
-def generate_title(prompt):
-    completion = client.chat.completions.create(
-      model="gpt-4o",
-      messages=[
-        {"role": "system", "content": "You are a helpful assistant. You are going to choose an appropriate title for the given string like chatgpt chooses the chat title"}, 
-        {"role": "user", "content": f"give me a suitable title for this {prompt}"}  
-      ]
-    )
+        record_call(trace, started, completion, "gpt-4o")
+        return completion
     
+    completion = get_scheduler().call(request, request_tokens(messages, completion_tokens=20), BACKGROUND, trace)
     return completion.choices[0].message.content
 
-
-def generate_matplotlib_code(description):
-    prompt = """
-    Generate a Python function named generate_plan that creates a Matplotlib figure representing the following floorplan description with the specified labels, dimensions, and positions. 
-    The function should:
-    - Create the floorplan using Matplotlib
-    - Ensure correct positions and dimensions of each element
-    - the drawing should be scaled. include the scale in the image.
-    - Annotate the elements with the specified labels and dimensions
-    - Return only the figure (fig)
-    -in annotations, mention feet and inches instead of ' and ". eg., 15'-5" as 15feet-5inch
-    -the label should be in ax.text and the dimensions should be in another ax.text. not in same
-    -make the font size small
-
-    Provide only the function definition as the response, nothing else.
-    An example output with desired format:
-import matplotlib.pyplot as plt
-
-def generate_plot():
-    fig, ax = plt.subplots()
-    ax.plot([0, 1, 2, 3], [10, 20, 25, 30])
-    ax.set_title("Sample Plot")
-    return fig
-
-    """
-
-    # Combine prompt and user description
-    combined_prompt = f"{prompt} {description}"
-    
-    messages = [
-        {"role": "system", "content": "You are an expert in generating Python Matplotlib code for visualizing floorplans. You understand how to create simple, rough floorplan diagrams using Python Matplotlib. You ensure that the orientations and positions of different elements are accurate. There are no overlaps between the elements."},
-        {"role": "user", "content": combined_prompt}
-    ]
-
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.0,
-    )
-
-    function_code = response.choices[0].message.content
+# Function to give a saved chat its generated title, run in the background after the chat is saved.
+# Titles are cached by digest, so identical conversations do not call the model again
+def title_chat(db, cache, metrics, chat_id, digest):
+    trace = Trace("title", chat_id=chat_id)
+    try:
+        # An empty title is never cached, so one left by an earlier version counts as a miss
+        title = cache.get(MODEL, digest, [], "title")
+        trace.cached = bool(title)
+        if not title:
+            # Chats with the same questions saved at the same time share one request
+            title = get_scheduler().coalesce(("title", digest), lambda: clean_title(generate_title(digest, trace)))
+            if title:
+                cache.put(MODEL, digest, [], "title", title)
+        if title:
+            with trace.span("db_write"):
+                db.rename_chat(chat_id, title)
+    except Exception as e:
+        trace.error = type(e).__name__
+        logging.getLogger(__name__).exception("Could not generate a title for chat %s", chat_id)
+    metrics.record(trace)
+
+
+# Function to get the validated spec for a description as canonical JSON, asking the model only on a cache miss
+def floorplan_spec(description, trace=None):
+    cache = get_plan_cache()
+    spec = cache.get_code(description, "json")
+    if trace is not None:
+        trace.cached = spec is not None
+    if spec is None:
+        # Sessions asking for the same plan at the same time share one request
+        spec = get_scheduler().coalesce(("spec", description), lambda: canonical_spec(parse_spec(
+            generate_floorplan_spec(get_client(), description, trace, get_scheduler()))))
+        cache.put_code(description, spec, "json")
+    return spec
+
+# Function to get the cleaned function code for a description, asking the model only on a cache miss.
+# New code is cached by the Generate page once it has rendered, so code that fails is asked for again
+def floorplan_code(description, trace=None):
+    cache = get_plan_cache()
+    function_code = cache.get_code(description)
+    if trace is not None:
+        trace.cached = function_code is not None
+    if function_code is None:
+        function_code = get_scheduler().coalesce(("code", description), lambda: generate_matplotlib_code(
+            get_client(), description, trace, get_scheduler()))
+        function_code = function_code.replace('python', '')
+        function_code = function_code.replace('```', '')
     return function_code
 
-def execute_function_code(function_code, function_name, *args, **kwargs):
-    # Execute the function code string
-    exec(function_code, globals())
-    # Call the function with the provided arguments
-    return globals()[function_name](*args, **kwargs)
+# Function to get the PNG and SVG renders of a plan, drawing it only on a cache miss.
+# A plan is ("spec", canonical JSON) or ("code", function code)
+def render_floorplan(plan, function_name='generate_plan', trace=None):
+    trace = trace or Trace("render")
+    kind, text = plan
+    cache = get_plan_cache()
+    png = cache.get_render(text, "png")
+    svg = cache.get_render(text, "svg")
+    if png is None or svg is None:
+        # Draw in a worker process and get the image bytes
+        with trace.span("render"):
+            if kind == "spec":
+                images = get_plot_pool().render_spec(parse_spec(text), ("png", "svg"))
+            else:
+                images = get_plot_pool().render(text, function_name, ("png", "svg"))
+        png, svg = images["png"], images["svg"]
+        cache.put_render(text, "png", png)
+        cache.put_render(text, "svg", svg)
+    return png, svg
+
+# Function to re-render a hand-edited spec on the Generate page
+def apply_spec_edit():
+    try:
+        st.session_state.plan = ("spec", canonical_spec(parse_spec(st.session_state.spec_editor)))
+    except SpecError as e:
+        st.session_state.spec_error = str(e)
+
+# Function to key an answered query by its normalized text, its images and the detail tier
+def turn_key(query, images, detail):
+    return (normalize_query(query), tuple(image.digest for image in images), detail)
+
+# Function to ask the model the last query again, in place of the similar earlier answer it was given
+def reask():
+    st.session_state.reask = st.session_state.chatHistory["ques"][-1]
+
+# Function to find the stored answer to an earlier query similar to this one about the same images, or None
+def find_similar(query, images, detail, trace):
+    with trace.span("similarity"):
+        return get_similarity_index().find(MODEL, detail, query, [image.phash for image in images],
+                                           SIMILARITY_THRESHOLD, IMAGE_HASH_MAX_DISTANCE)
+
+# Chat input and answer of the Home page. As a fragment, submitting a query redraws only this part of the page,
+# and a query is only answered on the run it was submitted in; other runs show the last answer again
+@st.experimental_fragment
+def home_chat(cho, img, detail, stream):
+    history = st.session_state.chatHistory
+    # Answers already given in this session, so asking the same thing again costs no API call
+    answered = st.session_state.setdefault("answered", {})
+    output_container = st.container()
+    with st.form("query_form", clear_on_submit=True, border=False):
+        query = st.text_input("Enter your query", placeholder="Type here")
+        fresh = st.checkbox("Bypass response cache", help="Ask the model again even if this question was answered before")
+        submitted = st.form_submit_button("Send")
+    
+    # The user turned down a similar earlier answer: drop that turn and put its query to the model, past every cache
+    if "reask" in st.session_state:
+        query, submitted, fresh = st.session_state.pop("reask"), True, True
+        for turn in history.values():
+            turn.pop()
+    
+    with output_container:
+        if not (submitted and query):
+            if history["ans"]:
+                st.write("You : " + history["ques"][-1])
+                st.info(history["ans"][-1])
+            return
+        if not (cho and img):
+            st.warning("Attach an image or paste an image link to ask about.")
+            return
+        
+        trace = Trace("query", st.session_state.session_id)
+        st.write("You : " + query)
+        try:
+            images = load_images(cho, img, detail, trace)
+            if not images:
+                raise FetchError("No image links were found")
+        except FetchError as e:
+            trace.error = type(e).__name__
+            st.error(str(e))
+        else:
+            key = turn_key(query, images, detail)
+            # Answers that build on earlier turns are neither offered for nor taken from other conversations
+            standalone = not earlier_turns(history, images)
+            if key in answered and not fresh:
+                trace.cached = True
+                resp = answered[key]
+                st.info(resp)
+                st.caption("Answered earlier in this session")
+            elif standalone and not fresh and (match := find_similar(query, images, detail, trace)):
+                trace.cached = True
+                resp = match.response
+                st.info(resp)
+                st.caption(f'Answer to a similar earlier question, "{match.query}" (similarity {match.score:.2f})')
+                st.button("Ask the model anyway", on_click=reask)
+            else:
+                try:
+                    resp = output(query, images, detail, stream, use_cache=not fresh, history=history, trace=trace)
+                    if resp is None or isinstance(resp, str):
+                        st.info(resp)
+                    else:
+                        # Render tokens as they arrive and keep the full text once the stream ends.
+                        # A stream that ends without any text raises EmptyAnswer here
+                        resp = st.write_stream(resp)
+                except EmptyAnswer as e:
+                    trace.error = type(e).__name__
+                    st.error(str(e))
+                    get_metrics().record(trace)
+                    return
+                answered[key] = resp
+                if resp and standalone and not trace.cached:
+                    get_similarity_index().add(MODEL, detail, query, [image.phash for image in images], resp)
+            history["ques"].append(query)
+            history["ans"].append(resp)
+            history["timestamp"].append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            history["images"].append([image.digest for image in images])
+        get_metrics().record(trace)
 
 
 # Streamlit UI
 st.set_page_config(page_title="VisualChat with GPT-4o")
 
+# Start the rendering workers with the first session, so they have imported Matplotlib by the time a plan is drawn
+get_plot_pool()
+
 # Sidebar with options and image handling
-st.sidebar.image("https://image.pitchbook.com/Tf5tfYnTZayaB4Yx7cSABAXNnaR1638562088465_200x200", width=200)
+st.sidebar.image(LOGO_URL, width=200)
 
 with st.sidebar:
     selected = option_menu(
         menu_title=None,
-        options=["Home", "History", "New Chat", "Prev Chats","Generate", "Guide"],
-        icons=["house","clock-history", "plus-circle","rewind","card-image","book"],
+        options=["Home", "History", "New Chat", "Prev Chats","Generate", "Metrics", "Guide"],
+        icons=["house","clock-history", "plus-circle","rewind","card-image","speedometer2","book"],
         menu_icon="cast",
         default_index=0,
         orientation="vertical"
@@ -141,6 +473,8 @@ cho = st.sidebar.selectbox("Select", ["None", "Attach image", "Paste the image l
 col1, col2 = st.columns(2)    
 
 img = None
+detail = "auto"
+stream = False
 if cho == "Attach image":
     img = st.sidebar.file_uploader("Upload the image(s)", accept_multiple_files=True)
     with col2:
@@ -148,144 +482,77 @@ if cho == "Attach image":
             st.image(img,use_column_width=True)
             
 elif cho == "Paste the image link":
-    img = st.sidebar.text_area("Enter the image link")
+    img = st.sidebar.text_area("Enter the image link(s), one per line")
     with col2:
         if img:
-            st.image(img,use_column_width=True)
+            st.image(parse_urls(img),use_column_width=True)
+
+if cho != "None":
+    detail = st.sidebar.selectbox("Image detail", DETAIL_TIERS)
+    stream = st.sidebar.toggle("Stream responses", value=True)
 
 if selected == "Guide":          
     st.markdown("<h1 style='text-align: center;'>App Guide</h1>", unsafe_allow_html=True)
     
     with st.expander("Overview and Components"):
-        st.markdown(
-        """
-        ## Overview
-        This Streamlit app allows users to interact with an AI chatbot powered by OpenAI's GPT-4o model. Users can enter queries, attach images, and save chat histories to a SQLite database.
-
-        ## Components
-
-        1. **Sidebar Navigation**
-           - Provides navigation options: Home, History, New Chat, Prev Chats.
-           - Options are represented with icons for clarity.
-
-        2. **Image Handling**
-           - Users can attach images via file upload or by pasting image links.
-           - Selected images are displayed in real-time.
-
-        3. **Chat Interface**
-           - **Home**: Enter queries and interact with the chatbot.
-           - Messages are displayed with timestamps.
-
-        4. **Saving Chats**
-           - **New Chat**: Save the current chat session to a SQLite database.
-           - Option to generate a title automatically or enter a custom title.
-           - Chat history is cleared after saving.
-
-        5. **History**
-           - Displays current session chat history with questions, responses, and timestamps.
-
-        6. **Previous Chats**
-           - Select and fetch historical chats stored in the SQLite database.
-           - Option to delete selected chat history.
-           
-        7. **Dynamic Plot Generation**
-           - **Generate**: Create floorplan visualizations based on user-provided descriptions.
-           - Use Matplotlib to dynamically generate and display floorplan images.
-           """)
+        st.markdown(load_asset("guide_overview.md"))
     
     with st.expander("Usage Guide"):
-        st.markdown("""
-        ### Home (Chat Interface)
-        - Enter your query in the text input field.
-        - Select image attachment options (Upload image, Paste image link).
-        - Interact with the chatbot and view responses in real-time.
-
-        ### New Chat (Save Chat)
-        - Click "New Chat" to save the current chat session.
-        - Choose to generate a title automatically or enter a custom title.
-        - Once saved, the chat history is cleared for a new session.
-
-        ### History
-        - View current session chat history, including questions, responses, and timestamps.
-        - Helpful for reviewing recent interactions.
-
-        ### Previous Chats
-        - Select from dropdown to fetch and view historical chat sessions stored in the database.
-        - Buttons to fetch or delete selected chat history.
-        
-        #### Dynamic Plot Generation
-
-        - **Generate Image**: Provide a floorplan description and click to generate visualizations.
-        - Matplotlib is used to create and display floorplan images based on user-provided descriptions.
-
-        ## Additional Features
-        - **CSS Customization**: Positions input at the bottom and adds styling for a cleaner UI.
-        - **Image Handling**: Supports image upload and link pasting within the chat interface.
-        - **Error Handling**: Displays errors or success messages during operations like saving or deleting chats.
-        """
-    )            
+        st.markdown(load_asset("guide_usage.md"))
 
 # Main content
 with col1:
     if selected == "Home":
-        output_container = st.container()       
-        query = st.text_input("Enter your query", placeholder="Type here")
-        if query and cho and img:
-            with output_container:
-                st.write("You : " + query)
-                st.session_state.chatHistory["ques"].append(query)
-                resp = output(query, cho, img)
-                st.info(resp)
-                st.session_state.chatHistory["ans"].append(resp)
-                st.session_state.chatHistory["timestamp"].append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-
-# Custom CSS for positioning the input at the bottom and adding a red rectangle block
-st.markdown(
-    """
-    <style>
-    .stTextInput {
-        position: fixed;
-        bottom: 0;
-        width: 50%;
-        left: 25%; 
-        background-color: #f0f0f0;
-        border: 1px solid #cccccc;
-        padding: 10px;
-        z-index: 10;
-    }
-    .stTextInput input {
-        background-color: #d4d4d4;
-        width: 100%;
-        border: none;
-        outline: none;
-        padding: 5px;
-        font-size: 14px;
-        border-radius: 5px;
-        box-sizing: border-box;
-    }
+        home_chat(cho, img, detail, stream)
+
+# Custom CSS for positioning the chat input at the bottom of Home and adding a red rectangle block
+if selected == "Home":
+    st.markdown(
+        """
+        <style>
+        .stTextInput {
+            position: fixed;
+            bottom: 0;
+            width: 50%;
+            left: 25%; 
+            background-color: #f0f0f0;
+            border: 1px solid #cccccc;
+            padding: 10px;
+            z-index: 10;
+        }
+        .stTextInput input {
+            background-color: #d4d4d4;
+            width: 100%;
+            border: none;
+            outline: none;
+            padding: 5px;
+            font-size: 14px;
+            border-radius: 5px;
+            box-sizing: border-box;
+        }
     
-    .white-space1 {
-        position: fixed;
-        bottom: 0;
-        left:0;
-        width: 25%;
-        height: 15.1%;
-        background-color: white;
-    }
+        .white-space1 {
+            position: fixed;
+            bottom: 0;
+            left:0;
+            width: 25%;
+            height: 15.1%;
+            background-color: white;
+        }
     
-    .white-space2 {
-        position: fixed;
-        right:6px;
-        bottom: 0;
-        width: 24.487%;
-        height: 15.1%;
-        background-color: white;
-    }
+        .white-space2 {
+            position: fixed;
+            right:6px;
+            bottom: 0;
+            width: 24.487%;
+            height: 15.1%;
+            background-color: white;
+        }
     
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+        </style>
+        """,
+        unsafe_allow_html=True
+    )
 
 if selected == "Home":
     st.markdown('<div class="white-space1"></div>', unsafe_allow_html=True)
@@ -301,51 +568,44 @@ if selected == "New Chat":
         opt = ["Enter custom title", "Generate a title"]
         rb = st.radio("Title for the chat",options=opt,index=0)
         
+        generate = False
         if rb == "Enter custom title":
             head = st.text_area("Enter the title")
         else:
             btn = st.button("Generate Title")
             if btn:
-                head = generate_title(st.session_state.chatHistory["ques"])
-                st.write("Generated Title : " + head)
+                # Save at once under a provisional title, the generated one replaces it when ready
+                head = provisional_title(st.session_state.chatHistory["ques"])
+                generate = True
         
         if head !="" and not head.isspace() and head != None:
             st.success("The chat has been saved")
         
-            # Connect to the database (or create it if it doesn't exist)
-            conn = sqlite3.connect('history.db')
-        
-            # Create a cursor object
-            cursor = conn.cursor()
-        
-            # Create table with specified columns
-            table_name = '_'.join(head.split())
-            
-            create_query = f'''
-                CREATE TABLE IF NOT EXISTS {table_name} (
-                    question TEXT NOT NULL,
-                    response TEXT NOT NULL,
-                    timestamp TEXT NOT NULL
-                )
-            '''
-            cursor.execute(create_query)
-            conn.commit()    
+            # Insert the chat and all of its messages in a single transaction
+            rows = zip(st.session_state.chatHistory["ques"],
+                       st.session_state.chatHistory["ans"],
+                       st.session_state.chatHistory["timestamp"])
+            trace = Trace("save", st.session_state.session_id)
+            # The chat's images must be stored before its messages can refer to them
+            with trace.span("image_wait"):
+                wait(st.session_state.pop("image_writes", []), timeout=IMAGE_STORE_TIMEOUT)
+            with trace.span("db_write"):
+                chat_id = get_db().save_chat(" ".join(head.split()), rows, st.session_state.chatHistory["images"])
+            get_background_pool().submit(get_image_store().collect)
+            # The requests made for this chat count towards its cost
+            get_metrics().assign_chat(st.session_state.session_id, chat_id)
+            trace.chat_id = chat_id
+            get_metrics().record(trace)
             
-            for i in range(len(st.session_state.chatHistory["ques"])):
-                val1 = st.session_state.chatHistory["ques"][i]
-                val2 = st.session_state.chatHistory["ans"][i]
-                val3 = st.session_state.chatHistory["timestamp"][i]
-                
-                # Insert data into the table
-                insert_query = f'''INSERT INTO {table_name} VALUES (?, ?, ?)'''
-                cursor.execute(insert_query, (val1, val2, val3))
-                conn.commit() 
+            if generate:
+                digest = conversation_digest(st.session_state.chatHistory["ques"])
+                get_background_pool().submit(title_chat, get_db(), get_response_cache(), get_metrics(), chat_id, digest)
+                st.write("Saved as : " + head + ". A generated title will replace it shortly.")
             
-            # Close the connection
-            conn.close()
-            
-            # Clear session state
-            st.session_state.chatHistory = {"ques": [], "ans": [], "timestamp": []}
+            # Clear session state, including the History page's expanded messages and pages, which are kept by index
+            st.session_state.chatHistory = new_chat_history()
+            st.session_state.pop("history_expanded", None)
+            st.session_state.pop("history_cursors", None)
         
             # Reset UI elements
             query = None
@@ -363,24 +623,44 @@ if selected == "History":
                      len(st.session_state.chatHistory["ans"]), 
                      len(st.session_state.chatHistory["timestamp"]))
     
-    history_data = {
-        'Question': st.session_state.chatHistory["ques"][:min_length],
-        'Response': st.session_state.chatHistory["ans"][:min_length],
-        'Timestamp': st.session_state.chatHistory["timestamp"][:min_length]
-    }
+    # Page through the session history by offset
+    cursors = st.session_state.setdefault("history_cursors", [0])
+    if cursors[-1] >= min_length:
+        cursors[:] = [0]
+    start = cursors[-1]
+    answers = st.session_state.chatHistory["ans"]
+    rows = [(i, st.session_state.chatHistory["ques"][i], answers[i][:PREVIEW_CHARS], len(answers[i]),
+             st.session_state.chatHistory["timestamp"][i])
+            for i in range(start, min(start + PAGE_SIZE, min_length))]
     
-    st.table(history_data)
+    render_messages(rows, lambda i: answers[i], "history")
+    render_pager("history", start + PAGE_SIZE if start + PAGE_SIZE < min_length else None)
 
 # Display database tables if "Prev Chats" is selected
 if selected == "Prev Chats":
     st.markdown("<h1 style='text-align: center;'>Previous Chat History</h1>", unsafe_allow_html=True)
     
-    # Get table names
-    table_names = get_table_names()
-    # Replacing the underscore with space for table name
-    tables_names = [" ".join(i.split("_")).capitalize() for i in table_names]
-    # Dropdown to select chat, display the chats in the reverse order
-    selected_table = st.selectbox("Select a chat", tables_names[::-1])
+    # Search across all saved chats
+    search = st.text_input("Search saved chats", placeholder="Search questions and responses")
+    if search:
+        results = get_db().search_messages(search)
+        if not results:
+            st.caption("No matching messages.")
+        for chat_id, title, message_id, question, response, timestamp in results:
+            st.markdown(f"**{title}** · {timestamp}")
+            st.markdown("You : " + question)
+            st.caption(response)
+            st.button("Open chat", key=f"search_{message_id}", on_click=open_search_result,
+                      args=((chat_id, title), message_id))
+        st.divider()
+    
+    # Get saved chats, newest first
+    chats = get_db().list_chats()
+    # Forget a selection whose chat has been deleted
+    if st.session_state.get("prev_chat_select") not in chats:
+        st.session_state.pop("prev_chat_select", None)
+    # Dropdown to select chat by its title
+    selected_chat = st.selectbox("Select a chat", chats, format_func=lambda chat: chat[1], key="prev_chat_select")
     
     btn1, _, _, _, _, btn2 = st.columns(6)
     
@@ -397,195 +677,137 @@ if selected == "Prev Chats":
         if st.button("Delete Chat"):
             delete_clicked = True
 
-    if fetch_clicked and selected_table:
-        table_data = fetch_table_data("_".join(selected_table.lower().split()))
-        df = pd.DataFrame(table_data)
-        df.columns = ["Question", "Response", "Timestamp"]
-        st.table(df)
+    # Remember the fetched chat so paging through it survives reruns
+    if fetch_clicked and selected_chat:
+        open_chat(selected_chat[0])
     
-    if delete_clicked and selected_table:
-        conn = sqlite3.connect('history.db')
-        cursor = conn.cursor()
-        cursor.execute(f"DROP TABLE IF EXISTS {'_'.join(selected_table.lower().split())}")
-        conn.commit()
-        conn.close()
-        st.success("Table deleted successfully.")
+    if delete_clicked and selected_chat:
+        get_db().delete_chat(selected_chat[0])
+        get_image_store().collect()
+        if st.session_state.get("open_chat") == selected_chat[0]:
+            st.session_state.open_chat = None
+        st.success("Chat deleted successfully.")
+    
+    elif selected_chat and st.session_state.get("open_chat") == selected_chat[0]:
+        rows, next_cursor = get_db().fetch_messages_page(selected_chat[0], st.session_state.chat_cursors[-1],
+                                                         PAGE_SIZE, PREVIEW_CHARS)
+        render_messages(rows, get_db().fetch_response, "chat", get_image_store().images_for([row[0] for row in rows]))
+        render_pager("chat", next_cursor)
         
-fig=None    
 if selected == "Generate":
     st.markdown("<h1 style='text-align: center;'>Dynamic Plot Generator</h1>", unsafe_allow_html=True)
     
     inp,gen = st.columns(2)
     with gen:
         with st.expander("Syntax"):
-            st.markdown("""
-                    **Floorplan Description:**
-                    - **Overall Dimensions:** `Overall Dimensions`
-                    - **Orientation:** `Orientation`
-                    
-                    **Rooms and Dimensions:**
-                    
-                    1. **Living Room:**
-                       - **Location:** `Living Room Location`
-                       - **Dimensions:** `Living Room Dimensions`
-                       - **Entry:** `Living Room Entry`
-                    
-                    2. **Hallway:**
-                       - **Location:** `Hallway Location`
-                       - **Dimensions:** `Hallway Dimensions`
-                       - **Entry:** `Hallway Entry`
-                    
-                    3. **Kitchen:**
-                       - **Location:** `Kitchen Location`
-                       - **Dimensions:** `Kitchen Dimensions`
-                       - **Entry:** `Kitchen Entry`
-                    
-                    4. **Master Bedroom (M.B.E.D):**
-                       - **Location:** `Master Bedroom Location`
-                       - **Dimensions:** `Master Bedroom Dimensions`
-                       - **Entry:** `Master Bedroom Entry`
-                       - **Attached Bath:**
-                         - **Location:** `Attached Bath Location`
-                         - **Dimensions:** `Attached Bath Dimensions`
-                    
-                    5. **Bedroom 1 (B.E.D):**
-                       - **Location:** `Bedroom 1 Location`
-                       - **Dimensions:** `Bedroom 1 Dimensions`
-                       - **Entry:** `Bedroom 1 Entry`
-                    
-                    6. **Common Bath:**
-                       - **Location:** `Common Bath Location`
-                       - **Dimensions:** `Common Bath Dimensions`
-                       - **Entry:** `Common Bath Entry`
-                    
-                    **Spacing and Orientation:**
-                    - `Room A` is located `Location A`, accessible from `Room B`.
-                    - `Room B` is centrally located, providing access to all other rooms.
-                    - `Room C` is located `Location C`, adjacent to `Room D`.
-                    """)
+            st.markdown(load_asset("syntax.md"))
         
         with st.expander("Example 1"):
-            st.markdown("""
-
-                            
-                        	**Floorplan Description** *(Copy & Edit)*\n
-                            o Overall Dimensions: 40' x 36'
-                            o Orientation: North is at the top of the plan.
-                            
-                            Rooms and Dimensions:
-                            1.	Drawing Room:
-                            o	Location: Bottom-left corner.
-                            o	Dimensions: 15'-5" x 14'-4"
-                            o	Entry: From the central dining area.
-                            
-                            2.	Dining Area:
-                            o	Location: Center of the plan.
-                            o	Dimensions: 9'-0" x 20'-3"
-                            o	Entry: Accessible from the drawing room, kitchen, and bedrooms.
-                            
-                            3.	Kitchen:
-                            o	Location: Top-right corner.
-                            o	Dimensions: 11'-0" x 9'-0"
-                            o	Entry: From the dining area.
-                            
-                            4.	Master Bedroom (M.B.E.D):
-                            o	Location: Top-right, adjacent to the kitchen.
-                            o	Dimensions: 12'-0" x 11'-0"
-                            o	Entry: From the dining area.
-                            o	Attached Bath:
-                            	Location: Top-right corner.
-                            	Dimensions: 7'-1" x 4'-0"
-                            
-                            5.	Bedroom 1 (B.E.D):
-                            o	Location: Top-left corner.
-                            o	Dimensions: 11'-0" x 11'-0"
-                            o	Entry: From the dining area.
-                            
-                            6.	Bedroom 2 (B.E.D):
-                            o	Location: Top-center.
-                            o	Dimensions: 11'-0" x 11'-0"
-                            o	Entry: From the dining area.
-                            
-                            7.	Master Bedroom (M.B.E.D):
-                            o	Location: Bottom-right corner.
-                            o	Dimensions: 11'-0" x 14'-4"
-                            o	Entry: From the dining area.
-                            o	Attached Bath:
-                            	Location: Bottom-right corner.
-                            	Dimensions: 9'-0" x 4'-0"
-                            
-                            8.	Common Bath:
-                            o	Location: Top-left, adjacent to Bedroom 1.
-                            o	Dimensions: 7'-1" x 4'-7"
-                            o	Entry: From the dining area.
-                            
-                            9.	Staircase:
-                            o	Location: Bottom-center.
-                            o	Dimensions: 7'-6" x 17'-10"
-                            o	Entry: From the dining area.
-                            
-                            Spacing and Orientation:
-                            •	The drawing room is directly accessible from the dining area and is located on the left side of the plan.
-                            •	The dining area is centrally located, providing access to all other rooms.
-                            •	The kitchen is located on the right side of the plan, adjacent to the master bedroom.
-                            •	The bedrooms are located on the top side of the plan, with two bedrooms on the left and one master bedroom on the right.
-                            •	The staircase is centrally located at the bottom of the plan, providing access to other floors.
-                            •	The common bath is located adjacent to Bedroom 1 on the top-left side of the plan.
-                            •	The master bedroom on the bottom-right has an attached bath, accessible from within the room. 
-                            """)
+            st.markdown(load_asset("example_1.md"))
         
         with st.expander("Example 2"):
-            st.markdown("""
-
-                            
-                        	**Floorplan Description** *(Copy & Edit)*\n
-                            o Overall Dimensions: 30' x 20'
-                            o Orientation: North is at the top
-                            
-                            Rooms and Dimensions:
-                            1.	Living Room:
-                            o	Location: Bottom-left corner
-                            o	Dimensions: 15' x 12'
-                            o	Entry: From the main hallway
-                            
-                            2.	Kitchen:
-                            o	Location: Bottom-right corner
-                            o	Dimensions: 10' x 8'
-                            o	Entry: From the dining area
-                            
-                            3.	Master Bedroom:
-                            o	Location: Top-left corner
-                            o	Dimensions: 12' x 10'
-                            o	Entry: From the main hallway
-                            o	Attached Bath:
-                            	Location: Adjacent to the bedrrom
-                            	Dimensions: 6' x 5'
-                            
-                            4.	Bedroom 1:
-                            o	Location: Top-right corner
-                            o	Dimensions: 10' x 10'
-                            o	Entry: From the main hallway
-                            
-                            Spacing and Orientation:
-                            •	The living room is located on the left side of the plan, accessible from the main hallway.
-                            •   The kitchen is on the right side, adjacent to the dining area.
-                            •   The bedrooms are located on the top side of the plan, with the master bedroom on the left and Bedroom 1 on the right. 
-                            """)
+            st.markdown(load_asset("example_2.md"))
     
     with inp:    
         description = st.text_area("Enter the description of the floorplan")
+        mode = st.radio("Drawing mode", ["Structured spec", "Python code"], horizontal=True,
+                        help="Structured spec asks the model for a compact JSON layout and draws it locally")
        
         if st.button("Generate Image"):
             if description:
-                # Assuming the function name generated by GPT is 'generate_plot'
-                function_name = 'generate_plan'
-                function_code = generate_matplotlib_code(description)
-                function_code = function_code.replace('python', '')
-                function_code = function_code.replace('```', '')
-                # Execute the function and get the figure
-                fig = execute_function_code(function_code, function_name)               
+                # Remember the plan so it stays on screen across reruns
+                trace = Trace("plan", st.session_state.session_id)
+                try:
+                    st.session_state.pop("plan_description", None)
+                    if mode == "Structured spec":
+                        st.session_state.plan = ("spec", floorplan_spec(description, trace))
+                    else:
+                        st.session_state.plan = ("code", floorplan_code(description, trace))
+                        # The code is cached under its description only once it has rendered
+                        st.session_state.plan_description = description
+                except SpecError as e:
+                    trace.error = type(e).__name__
+                    get_metrics().record(trace)
+                    st.error("The model returned an unusable spec: " + str(e))
+                else:
+                    # Recorded once the plan has been drawn below
+                    st.session_state.plan_trace = trace
             else: 
                 st.warning("Please enter a description of the floorplan.")
-    if fig:
-
-        st.pyplot(fig)
+    if st.session_state.get("plan"):
+        if st.session_state.plan[0] == "spec":
+            with st.expander("Spec"):
+                st.text_area("Edit the spec and re-render it locally", json.dumps(json.loads(st.session_state.plan[1]), indent=2),
+                             height=300, key="spec_editor")
+                st.button("Re-render", on_click=apply_spec_edit)
+                if st.session_state.get("spec_error"):
+                    st.error(st.session_state.pop("spec_error"))
+        # Assuming the function name generated by GPT is 'generate_plan'
+        trace = st.session_state.pop("plan_trace", None)
+        try:
+            png, svg = render_floorplan(st.session_state.plan, 'generate_plan', trace)
+        except RenderError as e:
+            if trace is not None:
+                trace.error = type(e).__name__
+            # Forget the plan, so later reruns of the page do not send the same failing job to a worker again
+            st.session_state.pop("plan", None)
+            st.session_state.pop("plan_description", None)
+            st.error("Could not draw the floorplan: " + str(e))
+        else:
+            if "plan_description" in st.session_state:
+                get_plan_cache().put_code(st.session_state.pop("plan_description"), st.session_state.plan[1])
+            st.image(png)
+            png_col, svg_col = st.columns(2)
+            with png_col:
+                st.download_button("Download PNG", png, file_name="floorplan.png", mime="image/png")
+            with svg_col:
+                st.download_button("Download SVG", svg, file_name="floorplan.svg", mime="image/svg+xml")
+        if trace is not None:
+            get_metrics().record(trace)
+
+# Show timings, token usage and cost from the metrics stored in history.db
+if selected == "Metrics":
+    st.markdown("<h1 style='text-align: center;'>Metrics</h1>", unsafe_allow_html=True)
+    
+    periods = {"Last hour": 60 * 60, "Last day": 24 * 60 * 60, "Last week": 7 * 24 * 60 * 60, "All time": None}
+    period = st.selectbox("Period", list(periods), index=1)
+    since = time.time() - periods[period] if periods[period] else 0
+    metrics = get_metrics()
+    
+    costs = metrics.chat_costs(since)
+    requests = sum(chat["requests"] for chat in costs)
+    cached = sum(chat["cached"] for chat in costs)
+    tokens = sum(chat["prompt_tokens"] + chat["completion_tokens"] for chat in costs)
+    requests_col, cached_col, tokens_col, cost_col = st.columns(4)
+    requests_col.metric("Requests", requests)
+    cached_col.metric("Cache hits", f"{cached / requests:.0%}" if requests else "-")
+    tokens_col.metric("Tokens", f"{tokens:,}")
+    cost_col.metric("Cost", f"${sum(chat['cost'] for chat in costs):.4f}")
+    
+    st.subheader("Timings")
+    st.caption("api is the round trip to the model and first_token the wait for the first streamed token. "
+               "The rest of total is spent in the app: fetching and encoding images, caches, database writes and rendering.")
+    st.dataframe(
+        [{"operation": stat["kind"], "step": stat["span"], "count": stat["count"],
+          **{f"p{round(q * 100)} ms": round(stat[f"p{round(q * 100)}"] * 1000, 1) for q in QUANTILES}}
+         for stat in metrics.span_stats(since)],
+        hide_index=True, use_container_width=True,
+    )
+    
+    st.subheader("Cost per chat")
+    st.caption("Image tokens are estimated from the size of the images sent and are included in the prompt tokens.")
+    st.dataframe(
+        [{"chat": chat["title"], "requests": chat["requests"], "cached": chat["cached"],
+          "prompt tokens": chat["prompt_tokens"], "completion tokens": chat["completion_tokens"],
+          "image tokens": chat["image_tokens"], "cost ($)": round(chat["cost"], 4)}
+         for chat in costs],
+        hide_index=True, use_container_width=True,
+    )
+    
+    jsonl_col, prometheus_col = st.columns(2)
+    with jsonl_col:
+        st.download_button("Export JSONL", "".join(metrics.export_jsonl(since)), file_name="metrics.jsonl",
+                           mime="application/jsonl")
+    with prometheus_col:
+        st.download_button("Export Prometheus", metrics.export_prometheus(since), file_name="metrics.prom",
+                           mime="text/plain")
@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from openai import OpenAI
+
+from db import Database, ResponseCache
+from fetch import ImageFetcher
+from images import ImageCache, prepare_images
+from scheduler import Scheduler
+from vision import MODEL, ask
+
+
+# Function to read JSONL records lazily, giving each one an id (its line number unless it has its own)
+def read_records(path):
+    with open(path, encoding="utf-8") as records:
+        for line_number, line in enumerate(records, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record["id"] = str(record.get("id", line_number))
+            yield record
+
+
+# Function to read the ids already done, and the chat results go to, from a checkpoint file
+def read_checkpoint(path):
+    done, chat_id = set(), None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as checkpoint:
+            for line in checkpoint:
+                entry = json.loads(line)
+                if "chat_id" in entry:
+                    chat_id = entry["chat_id"]
+                else:
+                    done.add(entry["id"])
+    return done, chat_id
+
+
+# Runs JSONL records through the same request-building logic as the app's output()
+class BatchRunner:
+    def __init__(self, client, db, image_cache_bytes=256 * 1024 * 1024, retries=5, cache_dir=".image_cache",
+                 rpm=500, tpm=30000):
+        self.client = client
+        self.db = db
+        self.cache = ResponseCache(db, ttl=7 * 24 * 60 * 60, max_entries=100000)
+        self.image_cache = ImageCache(image_cache_bytes)
+        self.image_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image")
+        self.fetcher = ImageFetcher(cache_dir)
+        # Keeps the run within the account's rate limits, retries failed requests and coalesces duplicate records
+        self.scheduler = Scheduler(rpm, tpm, retries, max_delay=60.0)
+
+    # Function to read an image from a local path or an http(s) URL
+    def load(self, source):
+        if source.startswith(("http://", "https://")):
+            return self.fetcher.fetch(source)
+        with open(source, "rb") as image_file:
+            return image_file.read()
+
+    # Function to answer a single record, returning its result
+    def run_record(self, record):
+        started = time.monotonic()
+        detail = record.get("detail", "auto")
+        try:
+            blobs = [self.load(source) for source in record.get("images", [])]
+            images = prepare_images(blobs, detail, self.image_cache, self.image_pool)
+            answer = ask(self.client, self.cache, record["query"], images, detail,
+                         use_cache=record.get("use_cache", True), model=record.get("model", MODEL),
+                         scheduler=self.scheduler)
+            result = {"id": record["id"], "query": record["query"], "answer": answer}
+        except Exception as e:
+            result = {"id": record["id"], "query": record.get("query"), "error": f"{type(e).__name__}: {e}"}
+        result["seconds"] = round(time.monotonic() - started, 3)
+        result["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return result
+
+    # Function to run records with at most concurrency requests in flight, passing each result to on_result
+    def run(self, records, concurrency, on_result):
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+            pending = set()
+            for record in records:
+                if len(pending) >= concurrency:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        on_result(future.result())
+                pending.add(executor.submit(self.run_record, record))
+            for future in wait(pending).done:
+                on_result(future.result())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer image queries from a JSONL file without the Streamlit UI.")
+    parser.add_argument("input", help='JSONL file of {"query": ..., "images": [paths or URLs], "detail": ..., "id": ...}')
+    parser.add_argument("--out", help="JSONL file the results are appended to")
+    parser.add_argument("--to-db", action="store_true", help="also save the answers as a chat in history.db")
+    parser.add_argument("--db", default="history.db", help="database for the response cache and saved chats")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--retries", type=int, default=5, help="retries per record on rate limits and server errors")
+    parser.add_argument("--rpm", type=int, default=500, help="requests per minute allowed by the account")
+    parser.add_argument("--tpm", type=int, default=30000, help="tokens per minute allowed by the account")
+    parser.add_argument("--checkpoint", help="file of finished record ids, used to resume (default: <input>.done)")
+    parser.add_argument("--base-url", help="OpenAI-compatible API base URL")
+    args = parser.parse_args(argv)
+    if not args.out and not args.to_db:
+        parser.error("give --out, --to-db or both")
+
+    checkpoint_path = args.checkpoint or args.input + ".done"
+    done, chat_id = read_checkpoint(checkpoint_path)
+    db = Database(args.db)
+    # Retries are handled here, so the client should not add its own
+    client = OpenAI(base_url=args.base_url, max_retries=0)
+    runner = BatchRunner(client, db, retries=args.retries, rpm=args.rpm, tpm=args.tpm)
+
+    out = open(args.out, "a", encoding="utf-8") if args.out else None
+    checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+    if args.to_db and chat_id is None:
+        chat_id = db.save_chat(f"Batch {os.path.basename(args.input)} {datetime.now():%Y-%m-%d %H:%M}", [])
+        checkpoint.write(json.dumps({"chat_id": chat_id}) + "\n")
+        checkpoint.flush()
+
+    counts = {"ok": 0, "error": 0}
+
+    def on_result(result):
+        if out:
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+        if "error" in result:
+            # Failed records are not checkpointed, so a resumed run tries them again
+            counts["error"] += 1
+            print(f"{result['id']}: {result['error']}", file=sys.stderr)
+            return
+        if args.to_db:
+            db.append_messages(chat_id, [(result["query"], result["answer"], result["timestamp"])])
+        checkpoint.write(json.dumps({"id": result["id"]}) + "\n")
+        checkpoint.flush()
+        counts["ok"] += 1
+
+    try:
+        records = (record for record in read_records(args.input) if record["id"] not in done)
+        runner.run(records, args.concurrency, on_result)
+    finally:
+        if out:
+            out.close()
+        checkpoint.close()
+    print(f"{counts['ok']} answered, {counts['error']} failed, {len(done)} skipped from an earlier run")
+    return 1 if counts["error"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
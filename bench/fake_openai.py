@@ -0,0 +1,137 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Canned answers, picked from what the request asks for
+PLAN_CODE = '''import matplotlib.pyplot as plt
+from matplotlib.patches import Rectangle
+
+def generate_plan():
+    fig, ax = plt.subplots()
+    rooms = [("Living Room", 0, 0, 15, 12), ("Kitchen", 20, 0, 10, 8), ("Master Bedroom", 0, 10, 12, 10)]
+    for name, x, y, w, h in rooms:
+        ax.add_patch(Rectangle((x, y), w, h, fill=False))
+        ax.text(x + w / 2, y + h / 2 + 0.5, name, ha="center", fontsize=6)
+        ax.text(x + w / 2, y + h / 2 - 0.5, f"{w}feet x {h}feet", ha="center", fontsize=5)
+    ax.set_xlim(0, 30)
+    ax.set_ylim(0, 20)
+    ax.set_aspect("equal")
+    return fig
+'''
+PLAN_SPEC = json.dumps({
+    "width": 30, "height": 20,
+    "rooms": [
+        {"name": "Living Room", "x": 0, "y": 0, "width": 15, "height": 12},
+        {"name": "Kitchen", "x": 20, "y": 0, "width": 10, "height": 8},
+        {"name": "Master Bedroom", "x": 0, "y": 10, "width": 12, "height": 10},
+        {"name": "Bedroom 1", "x": 20, "y": 10, "width": 10, "height": 10},
+    ],
+    "entries": [{"room": "Living Room", "wall": "right", "offset": 4, "width": 3}],
+})
+WORDS = "the floorplan shows a living room kitchen two bedrooms and a shared bath along the north wall".split()
+
+
+# Stand-in for the OpenAI chat completions API with configurable latency and token rate
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+    tokens_per_second = 200.0
+    completion_tokens = 60
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, request):
+        prompt = json.dumps(request.get("messages", []))
+        if request.get("response_format", {}).get("type") == "json_object":
+            return PLAN_SPEC
+        if "generate_plan" in prompt:
+            return PLAN_CODE
+        return " ".join(WORDS[i % len(WORDS)] for i in range(self.completion_tokens))
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        answer = self._answer(request)
+        tokens = answer.split(" ")
+        usage = {"prompt_tokens": len(json.dumps(request.get("messages", []))) // 4,
+                 "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": request.get("model", "gpt-4o")}
+        time.sleep(self.latency)
+
+        if not request.get("stream"):
+            # The full answer arrives after every token has been "generated"
+            time.sleep(len(tokens) / self.tokens_per_second)
+            body = json.dumps({**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+            ]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        for i, token in enumerate(tokens):
+            delta = {"content": token if i == 0 else " " + token}
+            send(json.dumps({**base, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": delta, "finish_reason": None}
+            ]}))
+            time.sleep(1 / self.tokens_per_second)
+        send(json.dumps({**base, "object": "chat.completion.chunk", "choices": [
+            {"index": 0, "delta": {}, "finish_reason": "stop"}
+        ]}))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send(json.dumps({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}))
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+# Server that drops the tracebacks of clients hanging up mid-stream
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# Function to start the fake server on a background thread, returning it and its OpenAI base URL
+def start_server(latency=0.05, tokens_per_second=200.0, completion_tokens=60, port=0):
+    handler = type("ConfiguredHandler", (FakeOpenAIHandler,), {
+        "latency": latency, "tokens_per_second": tokens_per_second, "completion_tokens": completion_tokens,
+    })
+    server = QuietServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the OpenAI chat completions API.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--tps", type=float, default=200.0, help="completion tokens per second")
+    parser.add_argument("--tokens", type=int, default=60, help="completion tokens per answer")
+    args = parser.parse_args()
+    server, base_url = start_server(args.latency, args.tps, args.tokens, args.port)
+    print(f"Fake OpenAI API at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,185 @@
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from openai import OpenAI
+from PIL import Image
+
+from bench.fake_openai import start_server
+from db import Database, ResponseCache
+from floorplan import canonical_spec, generate_floorplan_spec, generate_matplotlib_code, parse_spec
+from images import ImageCache, prepare_images
+from plot_worker import PlotWorkerPool
+from vision import ask
+
+IMAGE_SIZES = [(1024, 768), (2016, 1512), (4032, 3024)]
+HISTORY_SIZES = [10, 100, 1000]
+DESCRIPTION = "Overall Dimensions: 30' x 20'. Living room bottom-left 15' x 12', kitchen bottom-right 10' x 8'."
+
+
+# Function to time fn over a number of iterations, with up to concurrency calls at once
+def measure(fn, iterations, concurrency=1):
+    def timed(i):
+        started = time.perf_counter()
+        fn(i)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    if concurrency == 1:
+        latencies = [timed(i) for i in range(iterations)]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, range(iterations)))
+    return latencies, time.perf_counter() - started
+
+
+# Function to find the peak Python memory allocated by a few calls of fn, in a pass separate from timing
+def peak_memory(fn, iterations=2):
+    tracemalloc.start()
+    try:
+        for i in range(iterations):
+            fn(i)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Function to run one benchmark case and summarize it
+def run_case(name, fn, iterations, concurrency=1, setup=None):
+    if setup:
+        setup()
+    fn(-1)
+    latencies, wall = measure(fn, iterations, concurrency)
+    latencies.sort()
+    return {
+        "case": name,
+        "iterations": iterations,
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2),
+        "throughput_per_s": round(iterations / wall, 2),
+        "peak_mb": round(peak_memory(fn) / 1024 / 1024, 2),
+    }
+
+
+# Function to make a phone-photo-like JPEG of the given size
+def synthetic_jpeg(width, height):
+    image = Image.merge("RGB", [Image.effect_noise((width, height), sigma) for sigma in (40, 60, 80)])
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+
+def bench_encoding(iterations):
+    pool = ThreadPoolExecutor(max_workers=4)
+    results = []
+    for width, height in IMAGE_SIZES:
+        data = synthetic_jpeg(width, height)
+        # Cold: every call decodes, downscales and re-encodes; warm: every call hits the cache
+        results.append(run_case(f"encode cold {width}x{height}",
+                                lambda i: prepare_images([data], "auto", ImageCache(1 << 30), pool), iterations))
+        cache = ImageCache(1 << 30)
+        results.append(run_case(f"encode warm {width}x{height}",
+                                lambda i: prepare_images([data], "auto", cache, pool), iterations))
+        results.append(run_case(f"encode cold 4 x {width}x{height}",
+                                lambda i: prepare_images([data] * 4, "low", ImageCache(1 << 30), pool), iterations))
+    return results
+
+
+def bench_ask(client, db, iterations, concurrency):
+    cache = ResponseCache(db, ttl=3600, max_entries=1000)
+    images = prepare_images([synthetic_jpeg(2016, 1512)], "auto", ImageCache(1 << 30), ThreadPoolExecutor(1))
+
+    def first_token(i):
+        next(iter(ask(client, cache, "Describe the image", images, stream=True, use_cache=False)))
+
+    def full_stream(i):
+        "".join(ask(client, cache, "Describe the image", images, stream=True, use_cache=False))
+
+    return [
+        run_case("ask blocking", lambda i: ask(client, cache, "Describe the image", images, use_cache=False), iterations),
+        run_case("ask stream first token", first_token, iterations),
+        run_case("ask stream full", full_stream, iterations),
+        run_case(f"ask blocking x{concurrency} concurrent",
+                 lambda i: ask(client, cache, "Describe the image", images, use_cache=False), iterations, concurrency),
+        run_case("ask cache hit", lambda i: ask(client, cache, "Describe the image", images), iterations),
+    ]
+
+
+def bench_history(db, iterations):
+    results = []
+    for size in HISTORY_SIZES:
+        rows = [(f"Question {i} about the floorplan", "Answer " + "text " * 200, f"2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}")
+                for i in range(size)]
+        results.append(run_case(f"save chat {size} messages", lambda i: db.save_chat(f"bench {size}", rows), iterations))
+        chat_id = db.save_chat(f"bench {size}", rows)
+        _, middle = db.fetch_messages_page(chat_id, None, size // 2)
+        results.append(run_case(f"prev chats first page of {size}",
+                                lambda i: db.fetch_messages_page(chat_id, None, 20), iterations))
+        results.append(run_case(f"prev chats middle page of {size}",
+                                lambda i: db.fetch_messages_page(chat_id, middle, 20), iterations))
+    results.append(run_case("prev chats list", lambda i: db.list_chats(), iterations))
+    results.append(run_case("search", lambda i: db.search_messages("floorplan question"), iterations))
+    return results
+
+
+def bench_generate(client, iterations):
+    pool = PlotWorkerPool(size=1)
+    try:
+        return [
+            run_case("generate code + render",
+                     lambda i: pool.render(generate_matplotlib_code(client, DESCRIPTION), "generate_plan"), iterations),
+            run_case("generate spec + render",
+                     lambda i: pool.render_spec(parse_spec(canonical_spec(parse_spec(
+                         generate_floorplan_spec(client, DESCRIPTION))))), iterations),
+        ]
+    finally:
+        pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app's hot paths against a local fake OpenAI server.")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8, help="threads for the concurrent API case")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds before the first token")
+    parser.add_argument("--tps", type=float, default=200.0, help="fake API completion tokens per second")
+    parser.add_argument("--only", help="comma-separated subset of: encode, ask, history, generate")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    selected = set(args.only.split(",")) if args.only else {"encode", "ask", "history", "generate"}
+
+    server, base_url = start_server(args.latency, args.tps)
+    client = OpenAI(api_key="bench", base_url=base_url, max_retries=0, http_client=httpx.Client(timeout=60))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        if "encode" in selected:
+            results += bench_encoding(args.iterations)
+        if "ask" in selected:
+            results += bench_ask(client, db, args.iterations, args.concurrency)
+        if "history" in selected:
+            results += bench_history(db, args.iterations)
+        if "generate" in selected:
+            results += bench_generate(client, max(1, args.iterations // 4))
+    server.shutdown()
+
+    print(f"{'case':<40} {'p50 ms':>10} {'p95 ms':>10} {'ops/s':>10} {'peak MB':>10}")
+    for result in results:
+        print(f"{result['case']:<40} {result['p50_ms']:>10} {result['p95_ms']:>10} "
+              f"{result['throughput_per_s']:>10} {result['peak_mb']:>10}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as out:
+            json.dump({"latency": args.latency, "tps": args.tps, "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
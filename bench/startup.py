@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules app.py imports at startup, and the heavy ones that must only load on the pages that use them
+APP_MODULES = ["openai", "images", "db", "fetch", "plan_cache", "plot_worker", "floorplan", "context", "vision", "metrics", "scheduler", "similarity", "image_store"]
+LAZY_MODULES = ["pandas", "matplotlib"]
+
+# Budgets, in seconds: importing the app's modules in a fresh interpreter, the first script run of a
+# fresh server, and the p95 of later reruns
+IMPORT_BUDGET = 1.5
+FIRST_RUN_BUDGET = 3.0
+RERUN_BUDGET = 0.15
+
+IMPORT_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+print(json.dumps({{"seconds": time.perf_counter() - started,
+                   "loaded": [name for name in {lazy!r} if name in sys.modules]}}))
+'''
+
+
+# Function to time importing the app's modules in a fresh interpreter, as a new server process would
+def measure_imports():
+    probe = IMPORT_PROBE.format(modules=APP_MODULES, lazy=LAZY_MODULES)
+    output = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout)
+
+
+# Function to time the first run and later reruns of app.py with Streamlit's app testing harness.
+# Returns None when Streamlit is not installed
+def measure_reruns(reruns):
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        return None
+    app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    started = time.perf_counter()
+    app.run()
+    first = time.perf_counter() - started
+    times = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        app.run()
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return {"first_run": first, "p50": statistics.median(times), "p95": times[min(len(times) - 1, int(len(times) * 0.95))]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the app's startup and rerun times against their budgets.")
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--json", help="also write the measurements to this JSON file")
+    args = parser.parse_args(argv)
+
+    failures = []
+    imports = measure_imports()
+    print(f"imports      {imports['seconds']:.3f} s (budget {IMPORT_BUDGET} s)")
+    if imports["seconds"] > IMPORT_BUDGET:
+        failures.append("imports")
+    if imports["loaded"]:
+        print(f"loaded at startup, should be lazy: {', '.join(imports['loaded'])}")
+        failures.append("lazy imports")
+
+    reruns = measure_reruns(args.reruns)
+    if reruns is None:
+        print("streamlit is not installed; skipping the run budgets")
+    else:
+        print(f"first run    {reruns['first_run']:.3f} s (budget {FIRST_RUN_BUDGET} s)")
+        print(f"rerun p50    {reruns['p50']:.3f} s")
+        print(f"rerun p95    {reruns['p95']:.3f} s (budget {RERUN_BUDGET} s)")
+        if reruns["first_run"] > FIRST_RUN_BUDGET:
+            failures.append("first run")
+        if reruns["p95"] > RERUN_BUDGET:
+            failures.append("reruns")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as out:
+            json.dump({"imports": imports, "reruns": reruns, "failures": failures}, out, indent=2)
+    if failures:
+        print("over budget: " + ", ".join(failures))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import re
+
+# Budget of the conversation digest sent to the title prompt, and how much of each question it keeps
+TITLE_DIGEST_TOKENS = 300
+TITLE_QUESTION_CHARS = 200
+PROVISIONAL_TITLE_CHARS = 40
+
+
+# Function to estimate the number of tokens in a text, at roughly four characters per token
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+# Function to clip a text to max_chars, marking the cut with an ellipsis
+def clip(text, max_chars):
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars - 1].rstrip() + "…"
+
+
+# Function to build a bounded digest of the questions of a conversation for title generation
+def conversation_digest(questions, max_tokens=TITLE_DIGEST_TOKENS):
+    lines = []
+    used = 0
+    for question in questions:
+        line = "- " + clip(question, TITLE_QUESTION_CHARS)
+        cost = estimate_tokens(line)
+        if used + cost > max_tokens:
+            lines.append(f"- (and {len(questions) - len(lines)} more questions)")
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines)
+
+
+# Function to name a chat after its first question until a generated title is available
+def provisional_title(questions):
+    return clip(questions[0], PROVISIONAL_TITLE_CHARS) if questions else "Untitled chat"
+
+
+# Function to tidy a generated title, dropping quotes and a leading "Title:"
+def clean_title(title):
+    title = re.sub(r"^\s*title\s*:\s*", "", title.strip(), flags=re.IGNORECASE)
+    return " ".join(title.strip("\"'*# ").split())
+
+# Share of the context budget kept for recent turns verbatim, the rest holds a summary of older turns
+RECENT_SHARE = 0.75
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_QUESTION_CHARS = 150
+SUMMARY_ANSWER_CHARS = 300
+
+
+# Function to describe the images of an earlier turn, which are not sent again
+def image_note(turn_images, current_images):
+    if not turn_images:
+        return ""
+    if set(turn_images) <= set(current_images):
+        return " [asked about the same image(s) as the latest message]"
+    return f" [{len(turn_images)} earlier image(s), no longer shown]"
+
+
+# Function to compact older turns into a clipped summary that fits in budget tokens, keeping the newest ones
+def compact_turns(questions, answers, budget):
+    header = f"Summary of {len(questions)} earlier turn(s) of this conversation"
+    lines = []
+    used = estimate_tokens(header) + MESSAGE_OVERHEAD_TOKENS
+    for question, answer in zip(reversed(questions), reversed(answers)):
+        line = f"- Q: {clip(question, SUMMARY_QUESTION_CHARS)} A: {clip(answer, SUMMARY_ANSWER_CHARS)}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    if not lines:
+        return ""
+    if len(lines) < len(questions):
+        header += f" (the {len(questions) - len(lines)} oldest left out)"
+    return "\n".join([header + ":"] + lines[::-1])
+
+
+# Function to build the earlier turns of a conversation as chat messages within a token budget.
+# Recent turns are kept verbatim with their images replaced by a note, older turns are compacted into a summary
+def history_messages(questions, answers, images, current_images, budget):
+    turns = min(len(questions), len(answers))
+    images = list(images) + [[]] * (turns - len(images))
+    messages = []
+    used = 0
+    start = turns
+    while start > 0:
+        i = start - 1
+        question = questions[i] + image_note(images[i], current_images)
+        cost = estimate_tokens(question) + estimate_tokens(answers[i]) + 2 * MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget * RECENT_SHARE:
+            break
+        messages[:0] = [{"role": "user", "content": question}, {"role": "assistant", "content": answers[i]}]
+        used += cost
+        start = i
+    if start:
+        summary = compact_turns(questions[:start], answers[:start], budget - used)
+        if summary:
+            messages.insert(0, {"role": "system", "content": summary})
+    return messages
@@ -0,0 +1,472 @@
+import hashlib
+import json
+import queue
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Tables used by the app itself, as opposed to the legacy one-table-per-chat storage
+INTERNAL_TABLES = ("response_cache", "chats", "messages", "metric_requests", "metric_spans", "query_index",
+                   "image_blobs", "message_images")
+LEGACY_COLUMNS = ["question", "response", "timestamp"]
+
+# Connection settings: WAL lets readers proceed during a write, and NORMAL sync is durable enough under WAL
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+    "temp_store": "MEMORY",
+    "mmap_size": 64 * 1024 * 1024,
+}
+
+# Bumped whenever a migration is added to init_db
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS chats (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+        question TEXT NOT NULL,
+        response TEXT NOT NULL,
+        timestamp TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS chats_created_at ON chats (created_at);
+    CREATE INDEX IF NOT EXISTS messages_chat_timestamp ON messages (chat_id, timestamp);
+    CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        query TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS response_cache_last_used ON response_cache (last_used);
+    CREATE TABLE IF NOT EXISTS metric_requests (
+        id INTEGER PRIMARY KEY,
+        session TEXT NOT NULL,
+        chat_id INTEGER REFERENCES chats (id) ON DELETE SET NULL,
+        kind TEXT NOT NULL,
+        model TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        cached INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        completion_tokens INTEGER NOT NULL,
+        image_tokens INTEGER NOT NULL,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS metric_requests_started_at ON metric_requests (started_at);
+    CREATE INDEX IF NOT EXISTS metric_requests_session ON metric_requests (session, chat_id);
+    CREATE INDEX IF NOT EXISTS metric_requests_chat ON metric_requests (chat_id);
+    CREATE TABLE IF NOT EXISTS metric_spans (
+        request_id INTEGER NOT NULL REFERENCES metric_requests (id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        seconds REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS metric_spans_request ON metric_spans (request_id);
+    CREATE TABLE IF NOT EXISTS query_index (
+        id INTEGER PRIMARY KEY,
+        model TEXT NOT NULL,
+        detail TEXT NOT NULL,
+        query TEXT NOT NULL,
+        image_hashes TEXT NOT NULL,
+        response TEXT NOT NULL,
+        vector BLOB NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS image_blobs (
+        digest TEXT PRIMARY KEY,
+        mime TEXT NOT NULL,
+        width INTEGER NOT NULL,
+        height INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        stored_at REAL NOT NULL,
+        thumbnail BLOB NOT NULL,
+        data BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS message_images (
+        message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        digest TEXT NOT NULL REFERENCES image_blobs (digest),
+        PRIMARY KEY (message_id, position)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS message_images_digest ON message_images (digest);
+'''
+
+
+# Full-text index over questions and responses, kept in sync with messages by triggers
+SEARCH_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        question, response, content='messages', content_rowid='id', tokenize='porter unicode61'
+    );
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, question, response) VALUES (new.id, new.question, new.response);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, question, response)
+        VALUES ('delete', old.id, old.question, old.response);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, question, response)
+        VALUES ('delete', old.id, old.question, old.response);
+        INSERT INTO messages_fts (rowid, question, response) VALUES (new.id, new.question, new.response);
+    END;
+'''
+
+
+# Function to create the chat schema and run pending migrations, returning whether full-text search is available
+def init_db(conn):
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(SCHEMA)
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if version < 1:
+        with conn:
+            migrate_legacy_tables(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return init_search(conn)
+
+
+# Function to create the full-text index, filling it from existing messages the first time.
+# Returns False when SQLite was built without FTS5
+def init_search(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+    try:
+        conn.executescript(SEARCH_SCHEMA)
+    except sqlite3.OperationalError:
+        return False
+    if not exists:
+        with conn:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    return True
+
+
+# Function to import every legacy per-chat table into chats and messages, dropping the old tables
+def migrate_legacy_tables(conn):
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'").fetchall()
+    for (name,) in tables:
+        if name in INTERNAL_TABLES:
+            continue
+        quoted = '"' + name.replace('"', '""') + '"'
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quoted})")]
+        if columns != LEGACY_COLUMNS:
+            continue
+        rows = conn.execute(f"SELECT question, response, timestamp FROM {quoted} ORDER BY rowid").fetchall()
+        # Chats were saved right after their last message, and listed with this title
+        created_at = max((row[2] for row in rows), default=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        title = " ".join(name.split("_")).capitalize()
+        chat_id = conn.execute("INSERT INTO chats (title, created_at) VALUES (?, ?)", (title, created_at)).lastrowid
+        conn.executemany(
+            "INSERT INTO messages (chat_id, question, response, timestamp) VALUES (?, ?, ?, ?)",
+            [(chat_id,) + tuple(row) for row in rows],
+        )
+        conn.execute(f"DROP TABLE {quoted}")
+
+
+# Function to list saved chats as (id, title), newest first
+def list_chats(conn):
+    return conn.execute("SELECT id, title FROM chats ORDER BY created_at DESC, id DESC").fetchall()
+
+
+# Function to fetch one page of a chat's messages after a (timestamp, id) cursor, returning the rows and the next cursor.
+# Rows are (id, question, response preview, response length, timestamp), so long responses are only loaded on demand
+def fetch_messages_page(conn, chat_id, after=None, limit=20, preview_chars=500):
+    after = after or ("", 0)
+    rows = conn.execute(
+        '''SELECT id, question, substr(response, 1, ?), length(response), timestamp FROM messages
+           WHERE chat_id = ? AND (timestamp, id) > (?, ?) ORDER BY timestamp, id LIMIT ?''',
+        (preview_chars, chat_id, after[0], after[1], limit + 1),
+    ).fetchall()
+    next_cursor = (rows[limit - 1][4], rows[limit - 1][0]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# Function to fetch the full response of a single message
+def fetch_response(conn, message_id):
+    row = conn.execute("SELECT response FROM messages WHERE id = ?", (message_id,)).fetchone()
+    return row[0] if row else None
+
+
+# Function to find the page cursor that starts a chat page at the given message
+def message_cursor(conn, message_id):
+    row = conn.execute(
+        '''SELECT p.timestamp, p.id FROM messages m JOIN messages p ON p.chat_id = m.chat_id
+           WHERE m.id = ? AND (p.timestamp, p.id) < (m.timestamp, m.id) ORDER BY p.timestamp DESC, p.id DESC LIMIT 1''',
+        (message_id,),
+    ).fetchone()
+    return tuple(row) if row else None
+
+
+# Function to turn free text into an FTS5 query that matches all of its words, the last one as a prefix
+def fts_query(text):
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+# Function to search saved messages by relevance, returning
+# (chat id, chat title, message id, question snippet, response snippet, timestamp) rows with matches in bold
+def search_messages(conn, text, limit=20):
+    query = fts_query(text)
+    if not query:
+        return []
+    return conn.execute(
+        '''SELECT m.chat_id, c.title, m.id,
+                  snippet(messages_fts, 0, '**', '**', '…', 16),
+                  snippet(messages_fts, 1, '**', '**', '…', 24),
+                  m.timestamp
+           FROM messages_fts
+           JOIN messages m ON m.id = messages_fts.rowid
+           JOIN chats c ON c.id = m.chat_id
+           WHERE messages_fts MATCH ?
+           ORDER BY bm25(messages_fts, 2.0, 1.0) LIMIT ?''',
+        (query, limit),
+    ).fetchall()
+
+
+# Function to build a LIKE pattern, escaped with a backslash, that matches text anywhere in a value
+def like_pattern(text):
+    return "%" + text.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+# Function to search saved messages with LIKE when FTS5 is not available, newest first
+def search_messages_like(conn, text, limit=20):
+    pattern = like_pattern(text)
+    return conn.execute(
+        '''SELECT m.chat_id, c.title, m.id, substr(m.question, 1, 120), substr(m.response, 1, 200), m.timestamp
+           FROM messages m JOIN chats c ON c.id = m.chat_id
+           WHERE m.question LIKE ? ESCAPE '\\' OR m.response LIKE ? ESCAPE '\\'
+           ORDER BY m.timestamp DESC LIMIT ?''',
+        (pattern, pattern, limit),
+    ).fetchall()
+
+
+# Function to save a chat and its (question, response, timestamp) rows in one transaction, returning the new chat id.
+# images, if given, holds the content hashes of each row's images, which are attached to the message when stored
+def save_chat(conn, title, rows, images=()):
+    with conn:
+        chat_id = conn.execute(
+            "INSERT INTO chats (title, created_at) VALUES (?, ?)", (title, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO messages (chat_id, question, response, timestamp) VALUES (?, ?, ?, ?)",
+            [(chat_id,) + tuple(row) for row in rows],
+        )
+        if images:
+            # The chat is new, so its messages in id order are the rows just inserted
+            message_ids = [message_id for (message_id,) in conn.execute(
+                "SELECT id FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,)
+            )]
+            link_images(conn, [(message_id, position, digest) for message_id, digests in zip(message_ids, images)
+                               for position, digest in enumerate(digests)])
+    return chat_id
+
+
+# Function to attach images to messages by (message id, position, content hash), skipping images that are not stored
+def link_images(conn, links):
+    conn.executemany(
+        "INSERT INTO message_images (message_id, position, digest) SELECT ?, ?, digest FROM image_blobs WHERE digest = ?",
+        links,
+    )
+
+
+# Function to add (question, response, timestamp) rows to an existing chat in one transaction
+def append_messages(conn, chat_id, rows):
+    with conn:
+        conn.executemany(
+            "INSERT INTO messages (chat_id, question, response, timestamp) VALUES (?, ?, ?, ?)",
+            [(chat_id,) + tuple(row) for row in rows],
+        )
+
+
+# Function to fetch up to limit messages with an id above after, oldest first, for export, as
+# (message id, chat id, chat title, chat created_at, question, response, timestamp) rows.
+# since and until bound the message timestamps, inclusive, and title matches part of the chat title
+def fetch_export_page(conn, after=0, since=None, until=None, title=None, limit=1000):
+    clauses, params = ["m.id > ?"], [after]
+    if since:
+        clauses.append("m.timestamp >= ?")
+        params.append(since)
+    if until:
+        clauses.append("m.timestamp <= ?")
+        params.append(until)
+    if title:
+        clauses.append("c.title LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(title))
+    return conn.execute(
+        f'''SELECT m.id, m.chat_id, c.title, c.created_at, m.question, m.response, m.timestamp
+            FROM messages m JOIN chats c ON c.id = m.chat_id
+            WHERE {" AND ".join(clauses)} ORDER BY m.id LIMIT ?''',
+        params + [limit],
+    ).fetchall()
+
+
+# Function to import archived (source chat id, title, created_at, question, response, timestamp) rows in one
+# transaction. chat_ids maps source chat ids to local ones, and gets an entry for every chat created here
+def import_messages(conn, rows, chat_ids):
+    with conn:
+        for source, title, created_at, *_ in rows:
+            if source not in chat_ids:
+                chat_ids[source] = conn.execute(
+                    "INSERT INTO chats (title, created_at) VALUES (?, ?)", (title, created_at)
+                ).lastrowid
+        conn.executemany(
+            "INSERT INTO messages (chat_id, question, response, timestamp) VALUES (?, ?, ?, ?)",
+            [(chat_ids[row[0]],) + tuple(row[3:]) for row in rows],
+        )
+
+
+# Function to change the title of a saved chat
+def rename_chat(conn, chat_id, title):
+    with conn:
+        conn.execute("UPDATE chats SET title = ? WHERE id = ?", (title, chat_id))
+
+
+# Function to delete a chat together with its messages
+def delete_chat(conn, chat_id):
+    with conn:
+        conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+
+
+# Shared access to history.db through a pool of reusable connections
+class Database:
+    def __init__(self, path, pool_size=8):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        with self.connection() as conn:
+            self.search_enabled = init_db(conn)
+
+    def _open(self):
+        # Connections are handed between threads by the pool, never used by two at once
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for name, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    # Borrow a connection for the duration of the with block
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._pool.qsize() < self.pool_size:
+                self._pool.put(conn)
+            else:
+                conn.close()
+
+    def list_chats(self):
+        with self.connection() as conn:
+            return list_chats(conn)
+
+    def fetch_messages_page(self, chat_id, after=None, limit=20, preview_chars=500):
+        with self.connection() as conn:
+            return fetch_messages_page(conn, chat_id, after, limit, preview_chars)
+
+    def fetch_response(self, message_id):
+        with self.connection() as conn:
+            return fetch_response(conn, message_id)
+
+    def message_cursor(self, message_id):
+        with self.connection() as conn:
+            return message_cursor(conn, message_id)
+
+    def search_messages(self, text, limit=20):
+        with self.connection() as conn:
+            if self.search_enabled:
+                return search_messages(conn, text, limit)
+            return search_messages_like(conn, text, limit)
+
+    def save_chat(self, title, rows, images=()):
+        with self.connection() as conn:
+            return save_chat(conn, title, rows, images)
+
+    def append_messages(self, chat_id, rows):
+        with self.connection() as conn:
+            append_messages(conn, chat_id, rows)
+
+    def fetch_export_page(self, after=0, since=None, until=None, title=None, limit=1000):
+        with self.connection() as conn:
+            return fetch_export_page(conn, after, since, until, title, limit)
+
+    def import_messages(self, rows, chat_ids):
+        with self.connection() as conn:
+            import_messages(conn, rows, chat_ids)
+
+    def rename_chat(self, chat_id, title):
+        with self.connection() as conn:
+            rename_chat(conn, chat_id, title)
+
+    def delete_chat(self, chat_id):
+        with self.connection() as conn:
+            delete_chat(conn, chat_id)
+
+
+# Function to normalize a query so that trivially different spellings share a cache entry
+def normalize_query(query):
+    return " ".join(query.split()).casefold()
+
+
+# Function to build the cache key of a request from the model, the query and the content hashes of its images,
+# plus the earlier turns of the conversation when there are any
+def response_cache_key(model, query, image_hashes, detail, context=""):
+    payload = [model, normalize_query(query), list(image_hashes), detail]
+    if context:
+        payload.append(context)
+    payload = json.dumps(payload)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Persistent cache of model responses, with TTL and size-based eviction
+class ResponseCache:
+    def __init__(self, db, ttl, max_entries):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, model, query, image_hashes, detail, context=""):
+        key = response_cache_key(model, query, image_hashes, detail, context)
+        now = time.time()
+        with self.db.connection() as conn:
+            row = conn.execute(
+                "SELECT response FROM response_cache WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            with conn:
+                conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, model, query, image_hashes, detail, response, context=""):
+        key = response_cache_key(model, query, image_hashes, detail, context)
+        now = time.time()
+        with self.db.connection() as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, normalize_query(query), response, now, now),
+            )
+            self._evict(conn, now)
+
+    # Drop expired entries, then the least recently used ones above the size limit
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM response_cache WHERE created_at <= ?", (now - self.ttl,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+
+# Raised when an image link cannot be downloaded within the limits
+class FetchError(Exception):
+    pass
+
+
+# Content types that may hold an image; servers often label images as generic binary data
+BINARY_TYPES = ("application/octet-stream", "binary/octet-stream")
+
+
+# Function to split the pasted links into a list of URLs, one per non-empty line
+def parse_urls(text):
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+# Downloads image links concurrently over pooled connections, with size and time limits.
+# Downloads are kept on disk keyed by URL and revalidated with their ETag or Last-Modified.
+# Least recently used downloads are evicted once the cache grows past max_cache_bytes
+class ImageFetcher:
+    def __init__(self, cache_dir, max_bytes=20 * 1024 * 1024, timeout=15.0, max_workers=8, fresh_for=600, client=None,
+                 max_cache_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.timeout = timeout
+        self.fresh_for = fresh_for
+        self.client = client or httpx.Client(
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_workers, max_keepalive_connections=max_workers),
+        )
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fetch")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".bin"), os.path.join(self.cache_dir, key + ".json")
+
+    def _read_cached(self, url):
+        data_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            with open(data_path, "rb") as data_file:
+                data = data_file.read()
+            # Mark the entry as recently used
+            os.utime(data_path)
+            return meta, data
+        except (OSError, ValueError):
+            return None, None
+
+    def _write_cached(self, url, meta, data):
+        data_path, meta_path = self._paths(url)
+        # Write to temporary files first so a concurrent reader never sees half an entry. Every writer gets its
+        # own temporary file, as threads and sessions may fetch the same URL at once
+        for path, content in ((data_path, data), (meta_path, json.dumps(meta).encode("utf-8"))):
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as tmp_file:
+                    tmp_file.write(content)
+                os.replace(tmp_path, path)
+            except OSError:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        self._evict()
+
+    # Remove the least recently used downloads, data and metadata together, until the cache fits its budget
+    def _evict(self):
+        entries = {}
+        with os.scandir(self.cache_dir) as files:
+            for entry in files:
+                key, ext = os.path.splitext(entry.name)
+                if ext not in (".bin", ".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                used, size = entries.get(key, (0.0, 0))
+                entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_cache_bytes:
+                break
+            for ext in (".bin", ".json"):
+                try:
+                    os.remove(os.path.join(self.cache_dir, key + ext))
+                except OSError:
+                    pass
+            total -= size
+
+    # Function to download a single URL, returning its bytes
+    def fetch(self, url):
+        meta, cached = self._read_cached(url)
+        if cached is not None and time.time() - meta["fetched_at"] < self.fresh_for:
+            return cached
+
+        headers = {}
+        if cached is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        deadline = time.monotonic() + self.timeout
+        try:
+            with self.client.stream("GET", url, headers=headers) as response:
+                if response.status_code == 304 and cached is not None:
+                    data = cached
+                else:
+                    response.raise_for_status()
+                    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                    if content_type and not content_type.startswith("image/") and content_type not in BINARY_TYPES:
+                        raise FetchError(f"{url} is not an image (the server sent {content_type})")
+                    length = response.headers.get("Content-Length")
+                    if length and length.isdigit() and int(length) > self.max_bytes:
+                        raise FetchError(f"{url} is larger than {self.max_bytes} bytes")
+                    chunks = []
+                    size = 0
+                    for chunk in response.iter_bytes():
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise FetchError(f"{url} is larger than {self.max_bytes} bytes")
+                        if time.monotonic() > deadline:
+                            raise FetchError(f"{url} took longer than {self.timeout} seconds")
+                        chunks.append(chunk)
+                    data = b"".join(chunks)
+                etag = response.headers.get("ETag") or (meta or {}).get("etag")
+                last_modified = response.headers.get("Last-Modified") or (meta or {}).get("last_modified")
+        # A malformed URL is not an HTTPError, but is the user's mistake all the same
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            raise FetchError(f"Could not fetch {url}: {e}") from e
+
+        self._write_cached(url, {"url": url, "etag": etag, "last_modified": last_modified, "fetched_at": time.time()}, data)
+        return data
+
+    # Function to download several URLs concurrently, returning their bytes in order.
+    # A URL pasted more than once is downloaded once
+    def fetch_all(self, urls):
+        unique = list(dict.fromkeys(urls))
+        downloads = dict(zip(unique, self._executor.map(self.fetch, unique)))
+        return [downloads[url] for url in urls]
@@ -0,0 +1,240 @@
+import json
+import math
+import re
+import time
+
+from metrics import record_call
+from scheduler import INTERACTIVE, request_tokens, send
+
+# Instructions for the model: describe the plan as compact JSON instead of writing code
+SPEC_PROMPT = """
+Describe the following floorplan as a JSON object, nothing else. Use feet for every length, with inches as decimals
+or as strings like "15'-5\\"". The origin is the bottom-left corner of the plan, x grows to the east and y to the north.
+{
+  "width": overall width, "height": overall height,
+  "rooms": [{"name": label, "x": left edge, "y": bottom edge, "width": east-west size, "height": north-south size}],
+  "entries": [{"room": room name, "wall": "top" | "bottom" | "left" | "right", "offset": distance from the wall's
+               bottom or left end, "width": opening width}]
+}
+Rooms must stay inside the overall dimensions and must not overlap. Attached baths are separate rooms.
+"""
+
+WALLS = ("top", "bottom", "left", "right")
+DEFAULT_ENTRY_WIDTH = 3.0
+# How far, in feet, a room may reach past the overall dimensions, to allow for inches rounded in a spec
+BOUNDS_TOLERANCE = 1 / 12
+
+# Completion tokens reserved against the rate limits for generated code and for a spec
+CODE_COMPLETION_TOKENS = 1500
+SPEC_COMPLETION_TOKENS = 800
+
+
+# Raised when a floorplan spec is not valid JSON or misses required fields
+class SpecError(Exception):
+    pass
+
+
+# Function to read a length in feet from a number or a string such as 15'-5", 15 ft 5 in or 15feet-5inch
+def parse_length(value):
+    if isinstance(value, bool):
+        raise SpecError(f"Not a length: {value!r}")
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            raise SpecError(f"Not a length: {value!r}")
+        return float(value)
+    match = re.fullmatch(
+        r"\s*(\d+(?:\.\d+)?)\s*(?:'|ft|feet|foot)?\s*-?\s*(?:(\d+(?:\.\d+)?)\s*(?:\"|''|in|inch|inches))?\s*",
+        str(value),
+    )
+    if not match:
+        raise SpecError(f"Not a length: {value!r}")
+    return float(match.group(1)) + float(match.group(2) or 0) / 12
+
+
+# Function to write a length in feet the way the plans label it, e.g. 15feet-5inch
+def format_length(feet):
+    inches = round(feet * 12)
+    return f"{inches // 12}feet-{inches % 12}inch" if inches % 12 else f"{inches // 12}feet"
+
+
+# Function to parse and validate a spec, returning it with every length converted to feet
+def parse_spec(text):
+    try:
+        raw = json.loads(text) if isinstance(text, str) else text
+    except ValueError as e:
+        raise SpecError(f"The spec is not valid JSON: {e}") from e
+    if not isinstance(raw, dict) or not isinstance(raw.get("rooms"), list) or not raw["rooms"]:
+        raise SpecError("The spec needs a non-empty list of rooms")
+    try:
+        rooms = [
+            {"name": str(room.get("name", "")), **{key: parse_length(room[key]) for key in ("x", "y", "width", "height")}}
+            for room in raw["rooms"]
+        ]
+    except (KeyError, TypeError, AttributeError) as e:
+        raise SpecError(f"Every room needs x, y, width and height: {e}") from e
+    for room in rooms:
+        if room["width"] <= 0 or room["height"] <= 0:
+            raise SpecError(f"Room {room['name']!r} needs a positive width and height")
+    width = parse_length(raw["width"]) if "width" in raw else max(room["x"] + room["width"] for room in rooms)
+    height = parse_length(raw["height"]) if "height" in raw else max(room["y"] + room["height"] for room in rooms)
+    if width <= 0 or height <= 0:
+        raise SpecError("The plan needs a positive overall width and height")
+    for room in rooms:
+        if (room["x"] < -BOUNDS_TOLERANCE or room["y"] < -BOUNDS_TOLERANCE
+                or room["x"] + room["width"] > width + BOUNDS_TOLERANCE
+                or room["y"] + room["height"] > height + BOUNDS_TOLERANCE):
+            raise SpecError(f"Room {room['name']!r} lies outside the overall {format_length(width)} by "
+                            f"{format_length(height)} plan")
+
+    names = {room["name"] for room in rooms}
+    entries = []
+    for entry in raw.get("entries") or []:
+        if isinstance(entry, dict) and entry.get("room") in names and entry.get("wall") in WALLS:
+            entries.append({
+                "room": entry["room"],
+                "wall": entry["wall"],
+                "offset": parse_length(entry["offset"]) if "offset" in entry else None,
+                "width": parse_length(entry.get("width", DEFAULT_ENTRY_WIDTH)),
+            })
+    return {"width": width, "height": height, "rooms": rooms, "entries": entries}
+
+
+# Function to serialize a spec the same way every time, so equal plans share cache entries
+def canonical_spec(spec):
+    return json.dumps(spec, sort_keys=True, separators=(",", ":"))
+
+
+# Function to draw a parsed spec: all rooms in one PatchCollection, entries in one LineCollection,
+# label and dimension positions computed for all rooms at once
+def draw_floorplan(spec):
+    import numpy as np
+    from matplotlib.collections import LineCollection, PatchCollection
+    from matplotlib.colors import to_rgba_array
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Rectangle
+
+    rooms = spec["rooms"]
+    width, height = spec["width"], spec["height"]
+    boxes = np.array([[room["x"], room["y"], room["width"], room["height"]] for room in rooms])
+
+    fig = Figure(figsize=(8, max(3.0, min(12.0, 8 * height / width))))
+    ax = fig.add_subplot()
+    colors = to_rgba_array([f"C{i % 10}" for i in range(len(rooms))], alpha=0.25)
+    ax.add_collection(PatchCollection(
+        [Rectangle((x, y), w, h) for x, y, w, h in boxes], facecolor=colors, edgecolor="black", linewidth=1.5,
+    ))
+    ax.add_patch(Rectangle((0, 0), width, height, fill=False, edgecolor="black", linewidth=2.5))
+
+    # Labels sit just above the centre of each room and dimensions just below it, scaled to the room size
+    centres = boxes[:, :2] + boxes[:, 2:] / 2
+    font_sizes = np.clip(np.minimum(boxes[:, 2], boxes[:, 3]) * 0.8, 5, 9)
+    gaps = np.minimum(boxes[:, 3] * 0.12, 1.0)
+    for (cx, cy), gap, size, room in zip(centres, gaps, font_sizes, rooms):
+        ax.text(cx, cy + gap, room["name"], ha="center", va="bottom", fontsize=size, weight="bold")
+        ax.text(cx, cy - gap, f"{format_length(room['width'])} x {format_length(room['height'])}",
+                ha="center", va="top", fontsize=size * 0.85)
+
+    # Entries are drawn as white gaps in the wall of their room
+    by_name = {room["name"]: room for room in rooms}
+    segments = []
+    for entry in spec["entries"]:
+        room = by_name[entry["room"]]
+        horizontal = entry["wall"] in ("top", "bottom")
+        side = room["width"] if horizontal else room["height"]
+        span = min(entry["width"], side)
+        offset = entry["offset"] if entry["offset"] is not None else (side - span) / 2
+        offset = max(0.0, min(offset, side - span))
+        if horizontal:
+            y = room["y"] + (room["height"] if entry["wall"] == "top" else 0)
+            segments.append([(room["x"] + offset, y), (room["x"] + offset + span, y)])
+        else:
+            x = room["x"] + (room["width"] if entry["wall"] == "right" else 0)
+            segments.append([(x, room["y"] + offset), (x, room["y"] + offset + span)])
+    if segments:
+        ax.add_collection(LineCollection(segments, colors="white", linewidths=4, zorder=3))
+
+    # Scale bar of a round length below the plan, and the north arrow
+    bar = max(1, int(width / 4 // 5 * 5) or int(width / 4))
+    ax.plot([0, bar], [-height * 0.06] * 2, color="black", linewidth=3)
+    ax.text(bar / 2, -height * 0.08, f"Scale: {bar} feet", ha="center", va="top", fontsize=7)
+    ax.annotate("N", xy=(width * 1.04, height), xytext=(width * 1.04, height * 0.9),
+                ha="center", fontsize=8, arrowprops={"arrowstyle": "->"})
+
+    ax.set_xlim(-width * 0.02, width * 1.08)
+    ax.set_ylim(-height * 0.14, height * 1.02)
+    ax.set_aspect("equal")
+    ax.axis("off")
+    return fig
+
+
+# Function to have the model write a Matplotlib function drawing the floorplan
+def generate_matplotlib_code(client, description, trace=None, scheduler=None, priority=INTERACTIVE):
+    prompt = """
+    Generate a Python function named generate_plan that creates a Matplotlib figure representing the following floorplan description with the specified labels, dimensions, and positions. 
+    The function should:
+    - Create the floorplan using Matplotlib
+    - Ensure correct positions and dimensions of each element
+    - the drawing should be scaled. include the scale in the image.
+    - Annotate the elements with the specified labels and dimensions
+    - Return only the figure (fig)
+    -in annotations, mention feet and inches instead of ' and ". eg., 15'-5" as 15feet-5inch
+    -the label should be in ax.text and the dimensions should be in another ax.text. not in same
+    -make the font size small
+
+    Provide only the function definition as the response, nothing else.
+    An example output with desired format:
+import matplotlib.pyplot as plt
+
+def generate_plot():
+    fig, ax = plt.subplots()
+    ax.plot([0, 1, 2, 3], [10, 20, 25, 30])
+    ax.set_title("Sample Plot")
+    return fig
+
+    """
+
+    # Combine prompt and user description
+    combined_prompt = f"{prompt} {description}"
+    
+    messages = [
+        {"role": "system", "content": "You are an expert in generating Python Matplotlib code for visualizing floorplans. You understand how to create simple, rough floorplan diagrams using Python Matplotlib. You ensure that the orientations and positions of different elements are accurate. There are no overlaps between the elements."},
+        {"role": "user", "content": combined_prompt}
+    ]
+
+    def request():
+        started = time.perf_counter()
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            temperature=0.0,
+        )
+        record_call(trace, started, response, "gpt-4o")
+        return response
+
+    response = send(scheduler, request, request_tokens(messages, completion_tokens=CODE_COMPLETION_TOKENS), priority, trace)
+
+    function_code = response.choices[0].message.content
+    return function_code
+
+
+# Function to have the model describe the floorplan as a compact JSON spec
+def generate_floorplan_spec(client, description, trace=None, scheduler=None, priority=INTERACTIVE):
+    messages = [
+        {"role": "system", "content": "You are an expert in laying out floorplans. You ensure that the orientations and positions of different elements are accurate. There are no overlaps between the elements."},
+        {"role": "user", "content": f"{SPEC_PROMPT} {description}"}
+    ]
+
+    def request():
+        started = time.perf_counter()
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            temperature=0.0,
+            response_format={"type": "json_object"},
+        )
+        record_call(trace, started, response, "gpt-4o")
+        return response
+
+    response = send(scheduler, request, request_tokens(messages, completion_tokens=SPEC_COMPLETION_TOKENS), priority, trace)
+
+    return response.choices[0].message.content
@@ -0,0 +1,134 @@
+import argparse
+import importlib.util
+import json
+import sys
+
+from db import Database
+
+# Fields of an exported message, in column order
+FIELDS = ["chat_id", "title", "created_at", "question", "response", "timestamp"]
+
+
+# Function to read the messages matching the filters from the database, one chunk of dicts at a time
+def export_chunks(db, since=None, until=None, title=None, chunk_size=1000):
+    after = 0
+    while True:
+        rows = db.fetch_export_page(after, since, until, title, chunk_size)
+        if not rows:
+            return
+        after = rows[-1][0]
+        yield [dict(zip(FIELDS, row[1:])) for row in rows]
+
+
+# Function to write chunks of messages as JSON lines, returning the number written
+def write_jsonl(chunks, out):
+    count = 0
+    for chunk in chunks:
+        out.writelines(json.dumps(message) + "\n" for message in chunk)
+        count += len(chunk)
+    return count
+
+
+# Function to write chunks of messages to a Parquet file, one row group per chunk, returning the number written
+def write_parquet(chunks, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("chat_id", pa.int64())] + [(field, pa.string()) for field in FIELDS[1:]])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            count += len(chunk)
+    return count
+
+
+# Function to read exported messages from a JSONL file, one chunk of dicts at a time
+def read_jsonl(source, chunk_size=1000):
+    chunk = []
+    for line in source:
+        if line.strip():
+            chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+# Function to read exported messages from a Parquet file, one chunk of dicts at a time
+def read_parquet(path, chunk_size=1000):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=FIELDS):
+        yield batch.to_pylist()
+
+
+# Function to import chunks of exported messages, each chunk in one transaction, returning the chats and
+# messages created. Every exported chat becomes a new chat, so importing an archive twice duplicates it
+def import_chunks(db, chunks):
+    chat_ids = {}
+    count = 0
+    for chunk in chunks:
+        db.import_messages([tuple(message[field] for field in FIELDS) for message in chunk], chat_ids)
+        count += len(chunk)
+    return len(chat_ids), count
+
+
+# Function to pick the format from the option, or else from the file extension
+def file_format(path, option):
+    if option:
+        return option
+    return "parquet" if path.endswith((".parquet", ".pq")) else "jsonl"
+
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db", default="history.db")
+    common.add_argument("--format", choices=["jsonl", "parquet"], help="default: from the file extension")
+    common.add_argument("--chunk-size", type=int, default=1000, help="messages read and written at a time")
+    parser = argparse.ArgumentParser(description="Export saved chats to JSONL or Parquet, or import them back.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", parents=[common], help="write saved chats to a file ('-' for JSONL on stdout)")
+    export.add_argument("path")
+    export.add_argument("--since", help="only messages from this date or time on, e.g. 2024-06-01")
+    export.add_argument("--until", help="only messages up to this date or time, inclusive")
+    export.add_argument("--title", help="only chats whose title contains this text")
+    load = commands.add_parser("import", parents=[common], help="add the chats in a file ('-' for JSONL on stdin) as new chats")
+    load.add_argument("path")
+    args = parser.parse_args(argv)
+
+    fmt = file_format(args.path, args.format)
+    if fmt == "parquet" and args.path == "-":
+        parser.error("Parquet needs a file path")
+    if fmt == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        parser.error("Parquet needs pyarrow: pip install pyarrow")
+    db = Database(args.db)
+
+    if args.command == "export":
+        # A bare date as the upper bound includes the whole day
+        until = args.until + " 23:59:59" if args.until and len(args.until) == 10 else args.until
+        chunks = export_chunks(db, args.since, until, args.title, args.chunk_size)
+        if fmt == "parquet":
+            count = write_parquet(chunks, args.path)
+        elif args.path == "-":
+            count = write_jsonl(chunks, sys.stdout)
+        else:
+            with open(args.path, "w", encoding="utf-8") as out:
+                count = write_jsonl(chunks, out)
+        print(f"Exported {count} messages", file=sys.stderr)
+        return 0
+
+    if fmt == "parquet":
+        chats, count = import_chunks(db, read_parquet(args.path, args.chunk_size))
+    elif args.path == "-":
+        chats, count = import_chunks(db, read_jsonl(sys.stdin, args.chunk_size))
+    else:
+        with open(args.path, encoding="utf-8") as source:
+            chats, count = import_chunks(db, read_jsonl(source, args.chunk_size))
+    print(f"Imported {count} messages into {chats} chats", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
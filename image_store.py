@@ -0,0 +1,73 @@
+import time
+
+from images import make_thumbnail
+
+
+# Content-addressed store of the original images attached to queries, kept in history.db with a thumbnail each.
+# An image is stored once however many messages attach it. Images are stored when a query is answered, before
+# its chat is saved, so images no message refers to are only collected once they are older than orphan_ttl.
+# The data column comes last, so reading a thumbnail never walks the overflow pages of a large image
+class ImageStore:
+    def __init__(self, db, orphan_ttl):
+        self.db = db
+        self.orphan_ttl = orphan_ttl
+
+    # Store the original bytes of prepared images that are not stored yet, and refresh the age of those that are.
+    # Returns the number of images added
+    def put_all(self, images, blobs):
+        originals = {image.digest: data for image, data in zip(images, blobs)}
+        if not originals:
+            return 0
+        placeholders = ", ".join("?" * len(originals))
+        with self.db.connection() as conn:
+            stored = {digest for (digest,) in conn.execute(
+                f"SELECT digest FROM image_blobs WHERE digest IN ({placeholders})", list(originals)
+            )}
+        # Thumbnails are made outside the transaction, which only holds the write lock for the inserts
+        rows = []
+        now = time.time()
+        for digest, data in originals.items():
+            if digest not in stored:
+                thumbnail, mime, (width, height) = make_thumbnail(data)
+                rows.append((digest, mime, width, height, len(data), now, thumbnail, data))
+        with self.db.connection() as conn, conn:
+            conn.execute(f"UPDATE image_blobs SET stored_at = ? WHERE digest IN ({placeholders})", [now, *originals])
+            conn.executemany("INSERT OR IGNORE INTO image_blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    # Function to map each of the given messages that has images to its (digest, width, height) list, in order
+    def images_for(self, message_ids):
+        if not message_ids:
+            return {}
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                f'''SELECT m.message_id, b.digest, b.width, b.height FROM message_images m
+                    JOIN image_blobs b ON b.digest = m.digest
+                    WHERE m.message_id IN ({", ".join("?" * len(message_ids))}) ORDER BY m.message_id, m.position''',
+                list(message_ids),
+            ).fetchall()
+        images = {}
+        for message_id, digest, width, height in rows:
+            images.setdefault(message_id, []).append((digest, width, height))
+        return images
+
+    # Function to read the JPEG thumbnail of a stored image, or None
+    def thumbnail(self, digest):
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT thumbnail FROM image_blobs WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    # Function to read a stored image as (MIME type, original bytes), or None
+    def image(self, digest):
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT mime, data FROM image_blobs WHERE digest = ?", (digest,)).fetchone()
+        return tuple(row) if row else None
+
+    # Function to delete the images no message refers to that are older than orphan_ttl, returning how many
+    def collect(self):
+        with self.db.connection() as conn, conn:
+            return conn.execute(
+                '''DELETE FROM image_blobs WHERE stored_at < ?
+                   AND NOT EXISTS (SELECT 1 FROM message_images m WHERE m.digest = image_blobs.digest)''',
+                (time.time() - self.orphan_ttl,),
+            ).rowcount
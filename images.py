@@ -0,0 +1,187 @@
+import base64
+import hashlib
+import io
+import math
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image, ImageOps
+
+# Image formats the vision model accepts as-is
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+# Detail tiers and the resolution the model works at for each of them
+DETAIL_TIERS = ["auto", "low", "high"]
+LOW_DETAIL_SIDE = 512
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+JPEG_QUALITY = 85
+
+# Prompt tokens the model charges per image: a base amount, plus an amount per 512px tile above low detail
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIDE = 512
+
+# Side of the grayscale thumbnail a perceptual hash is computed from
+HASH_SIZE = 8
+
+# Longest side and JPEG quality of the thumbnails shown for the images of saved chats
+THUMBNAIL_SIDE = 256
+THUMBNAIL_QUALITY = 75
+
+# An image ready to be sent to the model, with the perceptual hash used to find near-identical images
+PreparedImage = namedtuple("PreparedImage", ["digest", "mime", "width", "height", "url", "phash"])
+
+
+# Function to compute the content hash used to key cached images
+def image_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# LRU cache of prepared images, keyed by content hash and bounded by total size of the payloads in bytes
+class ImageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = len(value.url)
+        # Entries larger than the whole budget are returned but never stored
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.url)
+            self._entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.url)
+        return value
+
+
+# Function to convert an image to a mode it can be resized and saved as JPEG or PNG in: 8-bit grayscale, RGB,
+# or RGB with alpha when it has transparency. 16-bit and floating point images, common for scans, are stretched
+# to the 8-bit range
+def standard_mode(image):
+    if image.mode in ("L", "LA", "RGB", "RGBA"):
+        return image
+    if image.mode.startswith("I") or image.mode == "F":
+        if image.mode != "F":
+            image = image.convert("I")
+        low, high = image.getextrema()
+        scale = 255 / (high - low) if high > low else 1
+        return image.point(lambda value: (value - low) * scale).convert("L")
+    if image.mode in ("PA", "La", "RGBa") or "transparency" in image.info:
+        return image.convert("RGBA")
+    return image.convert("RGB")
+
+
+# Function to compute the largest size the model uses for an image at the given detail tier
+def target_size(width, height, detail):
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_SIDE / max(width, height))
+    else:
+        # Fit within a 2048px square, then scale the shortest side down to 768px
+        scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height))
+        scale *= min(1.0, HIGH_DETAIL_SHORT_SIDE / (min(width, height) * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Function to compute the 64-bit difference hash of an image: whether each pixel of a small grayscale
+# thumbnail is brighter than its right neighbour. Resized or re-encoded copies differ in only a few bits
+def perceptual_hash(data):
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        pixels = list(standard_mode(image).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX).getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            bits = bits << 1 | (left > pixels[row * (HASH_SIZE + 1) + col + 1])
+    return bits
+
+
+# Function to make a small JPEG thumbnail of an image, returning its bytes, the image's MIME type and its size
+def make_thumbnail(data, side=THUMBNAIL_SIDE):
+    with Image.open(io.BytesIO(data)) as image:
+        mime = Image.MIME.get(image.format, "application/octet-stream")
+        size = image.size
+        # Orientations 5 to 8 turn the image on its side
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            size = size[::-1]
+        image.draft("RGB", (side, side))
+        image = standard_mode(ImageOps.exif_transpose(image))
+        image.thumbnail((side, side), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY)
+        return buffer.getvalue(), mime, size
+
+
+# Function to estimate the prompt tokens of an image of the given size at a detail tier
+def image_tokens(width, height, detail):
+    if detail == "low":
+        return IMAGE_BASE_TOKENS
+    width, height = target_size(width, height, "high")
+    tiles = math.ceil(width / IMAGE_TILE_SIDE) * math.ceil(height / IMAGE_TILE_SIDE)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+# Function to downscale and re-encode an image, returning its bytes, MIME type and size
+def preprocess_image(data, detail="auto"):
+    with Image.open(io.BytesIO(data)) as image:
+        mime = MIME_TYPES.get(image.format)
+        size = target_size(image.width, image.height, detail)
+        orientation = image.getexif().get(0x0112, 1)
+        # Small images in a supported format are sent untouched
+        if mime and size == image.size and orientation == 1:
+            return data, mime, size
+
+        # Let the JPEG decoder skip resolution we would throw away anyway
+        image.draft("RGB", size)
+        image = standard_mode(ImageOps.exif_transpose(image))
+        size = target_size(image.width, image.height, detail)
+        if size != image.size:
+            image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        buffer = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(buffer, format="PNG")
+            mime = "image/png"
+        else:
+            image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY)
+            mime = "image/jpeg"
+        return buffer.getvalue(), mime, image.size
+
+
+# Function to prepare a single image, preprocessing it only on a cache miss
+def prepare_image(data, detail, cache):
+    digest = image_digest(data)
+    key = f"{detail}:{digest}"
+    prepared = cache.get(key)
+    if prepared is None:
+        payload, mime, (width, height) = preprocess_image(data, detail)
+        url = f"data:{mime};base64,{base64.b64encode(payload).decode('utf-8')}"
+        prepared = cache.put(key, PreparedImage(digest, mime, width, height, url, perceptual_hash(payload)))
+    return prepared
+
+
+# Function to prepare several images in parallel on the given executor
+def prepare_images(blobs, detail, cache, executor):
+    if len(blobs) == 1:
+        return [prepare_image(blobs[0], detail, cache)]
+    return list(executor.map(lambda data: prepare_image(data, detail, cache), blobs))
@@ -0,0 +1,222 @@
+import argparse
+import json
+import math
+import sys
+import time
+from contextlib import contextmanager
+
+from db import Database
+
+# Dollars per million prompt and completion tokens
+PRICES = {"gpt-4o": (5.00, 15.00)}
+# Percentiles shown on the Metrics page and exported to Prometheus
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+# Timings and token usage of one user-facing operation, such as answering a query or generating a plan.
+# Spans are (name, seconds) pairs: encode, cache_read, api, first_token, cache_write, db_write, render
+class Trace:
+    def __init__(self, kind, session="", chat_id=None, model=None):
+        self.kind = kind
+        self.session = session
+        self.chat_id = chat_id
+        self.model = model
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.spans = []
+        self.cached = False
+        self.error = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.image_tokens = 0
+
+    # Time the with block as a span, even if it raises
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, time.perf_counter() - started))
+
+    def add_span(self, name, seconds):
+        self.spans.append((name, seconds))
+
+    # Add the token counts of an API response; usage is missing from some streamed responses
+    def add_usage(self, usage):
+        if usage is None:
+            return
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.completion_tokens += usage.completion_tokens or 0
+
+    def elapsed(self):
+        return time.perf_counter() - self._started
+
+
+# Function to add a blocking API call's duration since started and its token usage to a trace, if there is one
+def record_call(trace, started, response, model):
+    if trace is not None:
+        trace.model = model
+        trace.add_span("api", time.perf_counter() - started)
+        trace.add_usage(response.usage)
+
+
+# Function to compute the dollar cost of a number of tokens on a model
+def cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+# Function to pick the nearest-rank percentile q of a sorted list
+def percentile(values, q):
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+# Stores traces in history.db and summarizes them for the Metrics page and for export
+class MetricsStore:
+    def __init__(self, db):
+        self.db = db
+
+    # Save a finished trace with its spans, adding a "total" span for the whole operation
+    def record(self, trace):
+        spans = trace.spans + [("total", trace.elapsed())]
+        with self.db.connection() as conn, conn:
+            request_id = conn.execute(
+                '''INSERT INTO metric_requests (session, chat_id, kind, model, started_at, cached,
+                                                prompt_tokens, completion_tokens, image_tokens, error)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (trace.session, trace.chat_id, trace.kind, trace.model or "", trace.started_at, int(trace.cached),
+                 trace.prompt_tokens, trace.completion_tokens, trace.image_tokens, trace.error),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO metric_spans (request_id, name, seconds) VALUES (?, ?, ?)",
+                [(request_id, name, seconds) for name, seconds in spans],
+            )
+
+    # Attribute the session's requests made since its last save to the chat it was just saved as
+    def assign_chat(self, session, chat_id):
+        with self.db.connection() as conn, conn:
+            conn.execute("UPDATE metric_requests SET chat_id = ? WHERE session = ? AND chat_id IS NULL",
+                         (chat_id, session))
+
+    # Function to summarize span durations per (kind, span) since a unix time, with percentiles in seconds
+    def span_stats(self, since=0):
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                '''SELECT r.kind, s.name, s.seconds FROM metric_spans s JOIN metric_requests r ON r.id = s.request_id
+                   WHERE r.started_at >= ? ORDER BY r.kind, s.name, s.seconds''',
+                (since,),
+            ).fetchall()
+        groups = {}
+        for kind, name, seconds in rows:
+            groups.setdefault((kind, name), []).append(seconds)
+        return [
+            {"kind": kind, "span": name, "count": len(values), "sum": sum(values),
+             **{f"p{round(q * 100)}": percentile(values, q) for q in QUANTILES}}
+            for (kind, name), values in groups.items()
+        ]
+
+    # Function to total requests, tokens and cost per chat since a unix time; unsaved requests have chat id None
+    def chat_costs(self, since=0):
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                '''SELECT r.chat_id, c.title, r.model, COUNT(*), SUM(r.cached), SUM(r.prompt_tokens),
+                          SUM(r.completion_tokens), SUM(r.image_tokens)
+                   FROM metric_requests r LEFT JOIN chats c ON c.id = r.chat_id
+                   WHERE r.started_at >= ? GROUP BY r.chat_id, r.model''',
+                (since,),
+            ).fetchall()
+        chats = {}
+        for chat_id, title, model, requests, cached, prompt, completion, image in rows:
+            chat = chats.setdefault(chat_id, {
+                "chat_id": chat_id, "title": title or "Not saved", "requests": 0, "cached": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "image_tokens": 0, "cost": 0.0,
+            })
+            chat["requests"] += requests
+            chat["cached"] += cached
+            chat["prompt_tokens"] += prompt
+            chat["completion_tokens"] += completion
+            chat["image_tokens"] += image
+            chat["cost"] += cost(model, prompt, completion)
+        return sorted(chats.values(), key=lambda chat: chat["cost"], reverse=True)
+
+    # Function to yield every request since a unix time as a JSON line, with its spans
+    def export_jsonl(self, since=0):
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                '''SELECT r.id, r.session, r.chat_id, r.kind, r.model, r.started_at, r.cached, r.prompt_tokens,
+                          r.completion_tokens, r.image_tokens, r.error, s.name, s.seconds
+                   FROM metric_requests r LEFT JOIN metric_spans s ON s.request_id = r.id
+                   WHERE r.started_at >= ? ORDER BY r.id''',
+                (since,),
+            ).fetchall()
+        current = None
+        for row in rows:
+            if current is None or current["id"] != row[0]:
+                if current is not None:
+                    yield json.dumps(current) + "\n"
+                current = dict(zip(
+                    ("id", "session", "chat_id", "kind", "model", "started_at", "cached", "prompt_tokens",
+                     "completion_tokens", "image_tokens", "error"), row[:11]))
+                current["cost"] = cost(current["model"], current["prompt_tokens"], current["completion_tokens"])
+                current["spans"] = {}
+            if row[11] is not None:
+                current["spans"][row[11]] = current["spans"].get(row[11], 0) + row[12]
+        if current is not None:
+            yield json.dumps(current) + "\n"
+
+    # Function to render the metrics since a unix time in the Prometheus text exposition format
+    def export_prometheus(self, since=0):
+        lines = [
+            "# HELP visualchat_span_seconds Duration of instrumented steps",
+            "# TYPE visualchat_span_seconds summary",
+        ]
+        for stat in self.span_stats(since):
+            labels = f'kind="{stat["kind"]}",span="{stat["span"]}"'
+            for q in QUANTILES:
+                lines.append(f'visualchat_span_seconds{{{labels},quantile="{q}"}} {stat[f"p{round(q * 100)}"]:.6f}')
+            lines.append(f"visualchat_span_seconds_sum{{{labels}}} {stat['sum']:.6f}")
+            lines.append(f"visualchat_span_seconds_count{{{labels}}} {stat['count']}")
+
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                '''SELECT kind, model, COUNT(*), SUM(cached), SUM(error IS NOT NULL), SUM(prompt_tokens),
+                          SUM(completion_tokens), SUM(image_tokens)
+                   FROM metric_requests WHERE started_at >= ? GROUP BY kind, model''',
+                (since,),
+            ).fetchall()
+        counters = {
+            "requests_total": ("Instrumented operations", 2),
+            "cache_hits_total": ("Operations answered from a cache", 3),
+            "errors_total": ("Operations that failed", 4),
+            "prompt_tokens_total": ("Prompt tokens reported by the API, images included", 5),
+            "completion_tokens_total": ("Completion tokens reported by the API", 6),
+            "image_tokens_total": ("Estimated prompt tokens spent on images", 7),
+        }
+        for name, (help_text, column) in counters.items():
+            lines += [f"# HELP visualchat_{name} {help_text}", f"# TYPE visualchat_{name} counter"]
+            for row in rows:
+                lines.append(f'visualchat_{name}{{kind="{row[0]}",model="{row[1]}"}} {row[column]}')
+        lines += ["# HELP visualchat_cost_dollars_total Estimated API cost", "# TYPE visualchat_cost_dollars_total counter"]
+        for row in rows:
+            lines.append(f'visualchat_cost_dollars_total{{kind="{row[0]}",model="{row[1]}"}} {cost(row[1], row[5], row[6]):.6f}')
+        return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the timing and token metrics stored in history.db.")
+    parser.add_argument("--db", default="history.db")
+    parser.add_argument("--format", choices=["prometheus", "jsonl"], default="prometheus")
+    parser.add_argument("--since", type=float, default=0, help="only include the last this many hours")
+    args = parser.parse_args(argv)
+
+    store = MetricsStore(Database(args.db))
+    since = time.time() - args.since * 3600 if args.since else 0
+    if args.format == "prometheus":
+        sys.stdout.write(store.export_prometheus(since))
+    else:
+        sys.stdout.writelines(store.export_jsonl(since))
+
+
+if __name__ == "__main__":
+    main()
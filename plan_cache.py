@@ -0,0 +1,86 @@
+import hashlib
+import os
+import tempfile
+
+
+# Function to hash a text into a cache key
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Two-level disk cache for the Generate page: description hash -> function code or floorplan spec,
+# and code or spec hash -> rendered image.
+# Least recently used files are evicted once the cache grows past max_bytes
+class PlanCache:
+    def __init__(self, root, max_bytes=256 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        for level in ("code", "render"):
+            os.makedirs(os.path.join(root, level), exist_ok=True)
+
+    def _read(self, level, name):
+        path = os.path.join(self.root, level, name)
+        try:
+            with open(path, "rb") as cached:
+                data = cached.read()
+        except OSError:
+            return None
+        # Mark the entry as recently used, unless it has just been evicted
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def _write(self, level, name, data):
+        directory = os.path.join(self.root, level)
+        # Every writer gets its own temporary file, as sessions sharing a result write the same entry at once
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as cached:
+                cached.write(data)
+            os.replace(tmp_path, os.path.join(directory, name))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for level in ("code", "render"):
+            with os.scandir(os.path.join(self.root, level)) as files:
+                for entry in files:
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    # Another writer may have evicted the file since it was listed
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    # Descriptions differing only in whitespace share an entry; ext tells code ("py") and specs ("json") apart
+    def get_code(self, description, ext="py"):
+        data = self._read("code", f"{text_digest(' '.join(description.split()))}.{ext}")
+        return data.decode("utf-8") if data is not None else None
+
+    def put_code(self, description, code, ext="py"):
+        self._write("code", f"{text_digest(' '.join(description.split()))}.{ext}", code.encode("utf-8"))
+
+    def get_render(self, code, fmt):
+        return self._read("render", f"{text_digest(code)}.{fmt}")
+
+    def put_render(self, code, fmt, data):
+        self._write("render", f"{text_digest(code)}.{fmt}", data)
@@ -0,0 +1,145 @@
+import io
+import multiprocessing
+import queue
+import threading
+
+
+# Raised when generated plotting code fails, runs too long or takes its worker down
+class RenderError(Exception):
+    pass
+
+
+# Function run by each worker process: import Matplotlib and the spec renderer once, then render jobs until told to stop
+def _worker_main(conn, memory_limit):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from floorplan import draw_floorplan
+
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    conn.send(("ready", None))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        kind, payload, formats = job
+        try:
+            if kind == "spec":
+                fig = draw_floorplan(payload)
+            else:
+                # Each job gets a fresh namespace, so generated code cannot leak into later jobs
+                function_code, function_name = payload
+                namespace = {"__name__": "generated_plan"}
+                exec(function_code, namespace)
+                fig = namespace[function_name]()
+            images = {}
+            for fmt in formats:
+                buffer = io.BytesIO()
+                fig.savefig(buffer, format=fmt, bbox_inches="tight")
+                images[fmt] = buffer.getvalue()
+            conn.send(("ok", images))
+        except MemoryError:
+            conn.send(("crashed", "The plot ran out of memory"))
+            break
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+        finally:
+            plt.close("all")
+
+
+# A worker process and the pipe used to talk to it
+class _Worker:
+    def __init__(self, context, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.jobs = 0
+
+    def stop(self, graceful=True):
+        if graceful:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+# Pool of pre-started worker processes that run generated Matplotlib code outside the app process.
+# Jobs get a wall-clock timeout and a memory limit, and a worker that fails, hangs or has served
+# max_jobs jobs is replaced by a fresh one
+class PlotWorkerPool:
+    def __init__(self, size=2, timeout=30, memory_limit=2 * 1024 * 1024 * 1024, max_jobs=50, startup_timeout=60):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_jobs = max_jobs
+        self.startup_timeout = startup_timeout
+        # Spawned workers do not inherit the app's threads and open connections
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        for _ in range(size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        worker = _Worker(self._context, self.memory_limit)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _recycle(self, worker, graceful):
+        with self._lock:
+            self._workers.remove(worker)
+        worker.stop(graceful)
+        return self._spawn()
+
+    # Function to run function_name from function_code in a worker, returning {format: image bytes}
+    def render(self, function_code, function_name, formats=("png", "svg")):
+        return self._run(("code", (function_code, function_name), list(formats)))
+
+    # Function to draw a parsed floorplan spec in a worker, returning {format: image bytes}
+    def render_spec(self, spec, formats=("png", "svg")):
+        return self._run(("spec", spec, list(formats)))
+
+    def _run(self, job):
+        worker = self._idle.get()
+        healthy = False
+        try:
+            if not worker.ready:
+                if not worker.conn.poll(self.startup_timeout):
+                    raise RenderError("The rendering worker did not start")
+                worker.conn.recv()
+                worker.ready = True
+            worker.conn.send(job)
+            worker.jobs += 1
+            if not worker.conn.poll(self.timeout):
+                raise RenderError(f"Rendering took longer than {self.timeout} seconds")
+            status, payload = worker.conn.recv()
+            healthy = status != "crashed"
+            if status != "ok":
+                raise RenderError(payload)
+            return payload
+        except (EOFError, OSError):
+            raise RenderError("The rendering worker crashed")
+        finally:
+            if not healthy or worker.jobs >= self.max_jobs:
+                worker = self._recycle(worker, graceful=healthy)
+            self._idle.put(worker)
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
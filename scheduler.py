@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import openai
+
+from context import estimate_tokens
+
+# Priorities: interactive requests are let through before any waiting background request
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+# Completion tokens reserved for a request, whose actual length is only known once it finishes
+DEFAULT_COMPLETION_TOKENS = 500
+
+
+# Raised to the callers waiting on a coalesced request whose leader stopped before it had a result
+class Abandoned(Exception):
+    pass
+
+
+# Function to estimate the tokens a request counts against the TPM limit: its text, its images and the completion
+def request_tokens(messages, image_tokens=0, completion_tokens=DEFAULT_COMPLETION_TOKENS):
+    text = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            text += estimate_tokens(content)
+        else:
+            text += sum(estimate_tokens(part["text"]) for part in content if part.get("type") == "text")
+    return text + image_tokens + completion_tokens
+
+
+# Function to make an API request through the scheduler, or directly when there is none
+def send(scheduler, request, tokens, priority=INTERACTIVE, trace=None):
+    if scheduler is None:
+        return request()
+    return scheduler.call(request, tokens, priority, trace)
+
+
+# Token bucket refilled continuously at per_minute units a minute, holding at most a minute's worth
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until amount can be taken; an amount above the capacity waits for a full bucket
+    def delay(self, amount):
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    # Take amount, or give some back with a negative amount; the level may go below zero
+    def take(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+# Shared gate for API requests. Enforces requests-per-minute and tokens-per-minute limits with token buckets,
+# lets higher priority requests start first, retries retryable errors with jittered exponential backoff,
+# and lets concurrent identical requests share one upstream call
+class Scheduler:
+    def __init__(self, rpm, tpm, retries=4, base_delay=1.0, max_delay=30.0, join_timeout=120.0):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.join_timeout = join_timeout
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._order = itertools.count()
+        self._flights = {}
+
+    # Block until a request of the given estimated tokens may start. Waiters start in priority order,
+    # then in arrival order, and only the first in line draws from the buckets
+    def acquire(self, tokens, priority=INTERACTIVE):
+        ticket = (priority, next(self._order))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiting[0] == ticket:
+                        timeout = max(self._requests.delay(1), self._tokens.delay(tokens))
+                        if timeout == 0:
+                            self._requests.take(1)
+                            self._tokens.take(tokens)
+                            return
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    # Correct the token bucket once a request's actual usage is known
+    def settle(self, estimated, usage):
+        if usage is not None:
+            with self._cond:
+                self._tokens.take(usage.total_tokens - estimated)
+
+    # Function to compute the wait before retrying, honouring a Retry-After header when the API sends one
+    def backoff(self, attempt, error):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        response = getattr(error, "response", None)
+        try:
+            retry_after = float(response.headers.get("retry-after", 0)) if response is not None else 0
+        except ValueError:
+            retry_after = 0
+        return max(delay, min(retry_after, self.max_delay))
+
+    # Function to call fn under the rate limits, retrying retryable API errors. fn makes one API request;
+    # the wait for the limits is added to trace as a "queue" span
+    def call(self, fn, tokens, priority=INTERACTIVE, trace=None):
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            self.acquire(tokens, priority)
+            if trace is not None:
+                trace.add_span("queue", time.perf_counter() - started)
+            try:
+                result = fn()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff(attempt, e))
+            else:
+                self.settle(tokens, getattr(result, "usage", None))
+                return result
+
+    # Function to join the in-flight request with this key. Returns (True, None) when there is none, and the
+    # caller should make the request and land it, or (False, result) once the request it joined has landed.
+    # A caller that has waited longer than timeout, join_timeout by default, stops waiting and makes the request
+    # itself, so a flight that is never landed cannot hold up later requests for good
+    def join(self, key, timeout=None):
+        timeout = self.join_timeout if timeout is None else timeout
+        while True:
+            with self._cond:
+                future = self._flights.get(key)
+                if future is None:
+                    self._flights[key] = Future()
+                    return True, None
+            try:
+                return False, future.result(timeout)
+            except Abandoned:
+                continue
+            except FutureTimeout:
+                return True, None
+
+    # Function to end the in-flight request with this key, handing its result or error to the waiting callers.
+    # Only the first call for a flight has an effect
+    def land(self, key, result=None, error=None):
+        with self._cond:
+            future = self._flights.pop(key, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    # Function to run fn once for all concurrent callers with the same key, the others getting its result
+    def coalesce(self, key, fn):
+        leader, result = self.join(key)
+        if not leader:
+            return result
+        try:
+            result = fn()
+        except BaseException as e:
+            self.land(key, error=e if isinstance(e, Exception) else Abandoned())
+            raise
+        self.land(key, result)
+        return result
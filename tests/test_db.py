@@ -0,0 +1,51 @@
+import sqlite3
+
+from db import Database
+
+# Per-chat tables as the app used to save them, named after the chat, with rows in the order they were asked,
+# and the titles they are listed under once migrated
+TITLES = {"kitchen_plan": "Kitchen plan", 'Bob\'s "new" flat 2': 'Bob\'s "new" flat 2', "ünïcode_ä ö": "Ünïcode ä ö"}
+LEGACY = {
+    "kitchen_plan": [("how big is it", "12 m2", "2023-05-01 10:00:00"),
+                     ("where is the sink", "by the window", "2023-05-01 10:02:00")],
+    'Bob\'s "new" flat 2': [("describe the image", "a flat", "2023-06-02 09:30:00")],
+    "ünïcode_ä ö": [("what colour are the walls", "white", "2023-04-20 18:00:00"),
+                    ("and the floor", "oak", "2023-04-20 18:05:00"),
+                    ("any windows", "two", "2023-04-20 18:07:00")],
+}
+
+
+def legacy_table(conn, name, rows):
+    quoted = '"' + name.replace('"', '""') + '"'
+    conn.execute(f"CREATE TABLE {quoted} (question TEXT, response TEXT, timestamp TEXT)")
+    conn.executemany(f"INSERT INTO {quoted} VALUES (?, ?, ?)", rows)
+
+
+def test_legacy_tables_are_migrated_once(tmp_path):
+    path = str(tmp_path / "history.db")
+    with sqlite3.connect(path) as conn:
+        for name, rows in LEGACY.items():
+            legacy_table(conn, name, rows)
+        # Tables that are not chats are left alone
+        conn.execute("CREATE TABLE notes (question TEXT, answer TEXT)")
+    conn.close()
+
+    db = Database(path)
+    chats = db.list_chats()
+    # Listed by the time of each chat's last message
+    newest_first = ['Bob\'s "new" flat 2', "kitchen_plan", "ünïcode_ä ö"]
+    assert [title for _, title in chats] == [TITLES[name] for name in newest_first]
+    legacy = {TITLES[name]: rows for name, rows in LEGACY.items()}
+    with db.connection() as conn:
+        for chat_id, title in chats:
+            rows, _ = db.fetch_messages_page(chat_id)
+            assert [(question, response, timestamp) for _, question, response, _, timestamp in rows] == legacy[title]
+            (created_at,) = conn.execute("SELECT created_at FROM chats WHERE id = ?", (chat_id,)).fetchone()
+            assert created_at == legacy[title][-1][2]
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert "notes" in tables and not tables & set(LEGACY)
+
+    # A table in the old shape made after the migration is not imported again
+    with db.connection() as conn, conn:
+        legacy_table(conn, "late_chat", [("is it late", "yes", "2024-01-01 00:00:00")])
+    assert len(Database(path).list_chats()) == 3
@@ -0,0 +1,62 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from fetch import FetchError, ImageFetcher
+
+BODIES = {"/a.png": ("image/png", b"\x89PNG" + b"a" * 4000), "/b.png": ("image/png", b"\x89PNG" + b"b" * 4000),
+          "/page": ("text/html; charset=utf-8", b"<html></html>")}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content_type, body = BODIES[self.path]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def fetcher(cache_dir, **kwargs):
+    return ImageFetcher(str(cache_dir), client=httpx.Client(), fresh_for=0, **kwargs)
+
+
+def test_concurrent_fetches_of_one_url(tmp_path, base_url):
+    fetchers = [fetcher(tmp_path) for _ in range(4)]
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: fetchers[i % 4].fetch_all([base_url + "/a.png"] * 6), range(40)))
+    assert all(result == [BODIES["/a.png"][1]] * 6 for result in results)
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_non_image_body_is_a_fetch_error(tmp_path, base_url):
+    with pytest.raises(FetchError, match="not an image"):
+        fetcher(tmp_path).fetch(base_url + "/page")
+
+
+def test_malformed_url_is_a_fetch_error(tmp_path):
+    with pytest.raises(FetchError, match="Could not fetch"):
+        fetcher(tmp_path).fetch("http://[::1")
+
+
+def test_cache_is_evicted_past_its_budget(tmp_path, base_url):
+    images = fetcher(tmp_path, max_cache_bytes=6000)
+    images.fetch(base_url + "/a.png")
+    images.fetch(base_url + "/b.png")
+    assert len(list(tmp_path.glob("*.bin"))) == 1
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 6000
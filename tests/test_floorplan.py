@@ -0,0 +1,25 @@
+import pytest
+
+from floorplan import SpecError, parse_spec
+
+ROOMS = [{"name": "Hall", "x": 0, "y": 0, "width": "19'-9\"", "height": 16.25},
+         {"name": "Kitchen", "x": "19'-9\"", "y": 0, "width": 10.25, "height": 8}]
+
+
+def test_valid_spec_is_parsed():
+    spec = parse_spec({"width": 30, "height": 16.25, "rooms": ROOMS})
+    assert spec["rooms"][0]["width"] == pytest.approx(19.75)
+    assert parse_spec({"rooms": ROOMS})["width"] == pytest.approx(30)
+
+
+@pytest.mark.parametrize("spec, message", [
+    ({"width": 0, "height": 16.25, "rooms": ROOMS}, "positive overall"),
+    ({"rooms": [{"name": "Hall", "x": 0, "y": 0, "width": 0, "height": 10}]}, "positive width"),
+    ({"rooms": [{"name": "Hall", "x": 0, "y": 0, "width": 10, "height": -2}]}, "positive width"),
+    ({"width": 25, "height": 16.25, "rooms": ROOMS}, "outside"),
+    ({"width": 30, "height": 20, "rooms": [{"name": "Hall", "x": -3, "y": 0, "width": 10, "height": 10}]}, "outside"),
+    ({"rooms": [{"name": "Hall", "x": 0, "y": 0, "width": float("nan"), "height": 10}]}, "Not a length"),
+])
+def test_invalid_sizes_raise_spec_error(spec, message):
+    with pytest.raises(SpecError, match=message):
+        parse_spec(spec)
@@ -0,0 +1,47 @@
+import io
+import sqlite3
+
+from PIL import Image
+
+from db import Database
+from image_store import ImageStore
+from images import PreparedImage, image_digest
+
+
+def png(color, size=(300, 200)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def prepared(data):
+    return PreparedImage(image_digest(data), "image/png", 1, 1, "", 0)
+
+
+def test_chats_share_stored_images(tmp_path):
+    path = str(tmp_path / "history.db")
+    db = Database(path)
+    store = ImageStore(db, orphan_ttl=0)
+    red, blue = png("red"), png("blue")
+    assert store.put_all([prepared(red), prepared(blue)], [red, blue]) == 2
+    assert store.put_all([prepared(red)], [red]) == 0
+
+    rows = [("q1", "r1", "2024-01-01 00:00:00"), ("q2", "r2", "2024-01-01 00:00:01"), ("q3", "r3", "2024-01-01 00:00:02")]
+    first = db.save_chat("first", rows, [[image_digest(red), image_digest(blue)], [], [image_digest(red), "missing"]])
+    second = db.save_chat("second", rows[:1], [[image_digest(red)]])
+
+    message_ids = [row[0] for row in db.fetch_messages_page(first)[0]]
+    images = store.images_for(message_ids)
+    assert [digest for digest, _, _ in images[message_ids[0]]] == [image_digest(red), image_digest(blue)]
+    assert message_ids[1] not in images
+    assert [digest for digest, _, _ in images[message_ids[2]]] == [image_digest(red)]
+    assert images[message_ids[0]][0][1:] == (300, 200)
+    assert Image.open(io.BytesIO(store.thumbnail(image_digest(red)))).format == "JPEG"
+    assert store.image(image_digest(blue)) == ("image/png", blue)
+
+    # Images are removed once no chat refers to them
+    db.delete_chat(first)
+    assert store.collect() == 1
+    db.delete_chat(second)
+    assert store.collect() == 1
+    assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM image_blobs").fetchone() == (0,)
@@ -0,0 +1,42 @@
+import io
+
+import pytest
+from PIL import Image
+
+from images import make_thumbnail, perceptual_hash, preprocess_image
+
+
+def encoded(image, fmt):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+# A 16-bit grayscale gradient, as scanners produce
+def gradient_16bit(width=3000, height=2000):
+    image = Image.new("I", (width, height))
+    image.putdata([x * 65535 // width for _ in range(height) for x in range(width)])
+    return image.convert("I;16")
+
+
+@pytest.mark.parametrize("image, fmt", [
+    (gradient_16bit(), "PNG"),
+    (Image.new("F", (3000, 2000), 0.5), "TIFF"),
+    (Image.new("CMYK", (3000, 2000), (0, 128, 128, 0)), "TIFF"),
+    (Image.new("1", (3000, 2000), 1), "PNG"),
+])
+def test_unusual_modes_are_converted(image, fmt):
+    data = encoded(image, fmt)
+    payload, mime, size = preprocess_image(data)
+    assert max(size) <= 2048 and min(size) <= 768
+    assert Image.open(io.BytesIO(payload)).mode in ("RGB", "RGBA")
+    thumbnail, _, original = make_thumbnail(data)
+    assert original == (3000, 2000)
+    assert max(Image.open(io.BytesIO(thumbnail)).size) == 256
+    perceptual_hash(data)
+
+
+def test_16bit_image_keeps_its_contrast():
+    payload, _, _ = preprocess_image(encoded(gradient_16bit(), "PNG"))
+    low, high = Image.open(io.BytesIO(payload)).convert("L").getextrema()
+    assert low < 10 and high > 245
@@ -0,0 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from plan_cache import PlanCache
+
+
+def test_concurrent_writes_of_one_entry(tmp_path):
+    cache = PlanCache(str(tmp_path), max_bytes=10_000)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: cache.put_render("code", "png", b"x" * 3000), range(40)))
+        list(pool.map(lambda i: cache.put_code("a plan", "def generate_plan(): pass"), range(40)))
+    assert cache.get_render("code", "png") == b"x" * 3000
+    assert cache.get_code("a  plan") == "def generate_plan(): pass"
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_eviction_keeps_the_cache_within_budget(tmp_path):
+    cache = PlanCache(str(tmp_path), max_bytes=5000)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: cache.put_render(f"code {i}", "png", b"x" * 1000), range(40)))
+    assert sum(path.stat().st_size for path in tmp_path.rglob("*.png")) <= 5000
@@ -0,0 +1,72 @@
+import pytest
+
+from db import Database
+from similarity import DEFAULT_THRESHOLD, SimilarityIndex, content_words
+
+# Questions asked the same way across chats, which should be offered each other's answers
+PARAPHRASES = [
+    ("describe the image", "describe this image"),
+    ("what colour is the image", "what is the color of the image"),
+    ("how many windows are there", "how many windows are in the room?"),
+    ("what is the total area of the floorplan", "what's the floorplan's total area"),
+    ("list the furniture in the room", "list all furniture in this room"),
+    ("where is the kitchen", "where's the kitchen located"),
+    ("where exactly is the kitchen", "where is the kitchen"),
+    ("how many bedrooms does it have", "how many bedrooms are there"),
+    ("summarize the image", "give a summary of the image"),
+    ("how many rooms are in the floorplan", "how many rooms does the floorplan have"),
+    ("what colour are the walls", "What color are the walls?"),
+]
+# Different questions about the same image, which must not be
+DISTINCT = [
+    ("how many windows are there", "how many doors are there"),
+    ("what color is the sofa", "what color is the wall"),
+    ("describe the image", "describe the kitchen"),
+    ("how many bedrooms are there", "how many bathrooms are there"),
+    ("where is the kitchen", "where is the bathroom"),
+    ("what is the area of the kitchen", "what is the area of the bedroom"),
+    ("describe the image", "what is in the image"),
+    ("is there a window", "is there a door"),
+    ("is there a window", "is there no window"),
+    ("what is the total area", "what is the total cost"),
+    ("list the furniture in the room", "list the colors in the room"),
+    # Asking for a short answer or a long one
+    ("briefly describe the image", "describe this image in detail"),
+    ("describe the image", "describe this image in one sentence"),
+    ("give a short summary", "summarize in detail"),
+]
+# Other questions already in the index, which the IDF weights are computed over
+ASKED = ["what style is the house", "is this a modern building", "count the chairs", "what is the person doing",
+         "translate the text", "what brand is the car", "estimate the size of the living room", "how old is the building"]
+
+
+def index_with(tmp_path, question):
+    index = SimilarityIndex(Database(str(tmp_path / "history.db")), max_entries=100)
+    for asked in ASKED + [question]:
+        index.add("gpt-4o", "auto", asked, [0x0F0F], f"answer to {asked}")
+    return index
+
+
+@pytest.mark.parametrize("earlier, query", PARAPHRASES)
+def test_paraphrases_match(tmp_path, earlier, query):
+    match = index_with(tmp_path, earlier).find("gpt-4o", "auto", query, [0x0F0F])
+    assert match is not None and match.query == earlier, match
+    assert match.score >= DEFAULT_THRESHOLD
+
+
+@pytest.mark.parametrize("earlier, query", DISTINCT)
+def test_distinct_questions_do_not_match(tmp_path, earlier, query):
+    assert index_with(tmp_path, earlier).find("gpt-4o", "auto", query, [0x0F0F]) is None
+
+
+def test_different_images_or_detail_do_not_match(tmp_path):
+    index = index_with(tmp_path, "describe the image")
+    assert index.find("gpt-4o", "auto", "describe the image", [0xF0F0]) is None
+    assert index.find("gpt-4o", "high", "describe the image", [0x0F0F]) is None
+    # A re-encoded copy differs in a few bits of its hash
+    assert index.find("gpt-4o", "auto", "describe the image", [0x0F0E]) is not None
+
+
+def test_content_words():
+    assert content_words("What's the colour of the walls?") == ["color", "walls"]
+    assert content_words("What is this?") == ["what", "is", "this"]
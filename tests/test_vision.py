@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from db import Database, ResponseCache
+from images import PreparedImage
+from scheduler import Scheduler
+from vision import EmptyAnswer, ask
+
+IMAGE = PreparedImage("abc", "image/png", 64, 64, "data:image/png;base64,", 0)
+
+
+class FakeClient:
+    def __init__(self, *contents):
+        self.contents = list(contents)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.calls += 1
+        message = SimpleNamespace(content=self.contents.pop(0))
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+        if kwargs.get("stream"):
+            # One chunk with the text, if any, then the usage chunk
+            chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=message)], usage=None)] if message.content else []
+            return iter(chunks + [SimpleNamespace(choices=[], usage=usage)])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+class FailingCache:
+    def get(self, *args):
+        return None
+
+    def put(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(Database(str(tmp_path / "history.db")), ttl=60, max_entries=10)
+
+
+# Function to call ask in a thread, failing the test if it is still blocked after a few seconds
+def ask_within(seconds, *args, **kwargs):
+    result = {}
+
+    def run():
+        try:
+            result["answer"] = ask(*args, **kwargs)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), "ask() is still waiting on a flight that was never landed"
+    if "error" in result:
+        raise result["error"]
+    return result["answer"]
+
+
+def test_empty_answer_is_not_cached_and_releases_the_flight(cache):
+    scheduler = Scheduler(rpm=600, tpm=100000)
+    client = FakeClient(None, "A kitchen")
+    with pytest.raises(EmptyAnswer):
+        ask(client, cache, "describe", [IMAGE], scheduler=scheduler)
+    assert scheduler._flights == {}
+    assert ask_within(3, client, cache, "describe", [IMAGE], scheduler=scheduler) == "A kitchen"
+    assert client.calls == 2
+
+
+def test_empty_stream_is_not_cached(cache):
+    scheduler = Scheduler(rpm=600, tpm=100000)
+    client = FakeClient("", "A kitchen")
+    with pytest.raises(EmptyAnswer):
+        list(ask(client, cache, "describe", [IMAGE], stream=True, scheduler=scheduler))
+    assert scheduler._flights == {}
+    assert "".join(ask(client, cache, "describe", [IMAGE], stream=True, scheduler=scheduler)) == "A kitchen"
+    assert client.calls == 2
+
+
+def test_cache_write_error_releases_the_flight():
+    scheduler = Scheduler(rpm=600, tpm=100000)
+    client = FakeClient("A kitchen", "A kitchen")
+    with pytest.raises(sqlite3.OperationalError):
+        ask(client, FailingCache(), "describe", [IMAGE], scheduler=scheduler)
+    assert scheduler._flights == {}
+    with pytest.raises(sqlite3.OperationalError):
+        ask_within(3, client, FailingCache(), "describe", [IMAGE], scheduler=scheduler)
+
+
+def test_join_gives_up_waiting_after_its_timeout():
+    scheduler = Scheduler(rpm=600, tpm=100000, join_timeout=0.1)
+    assert scheduler.join("key") == (True, None)
+    assert scheduler.join("key") == (True, None)
@@ -0,0 +1,124 @@
+import json
+import time
+
+from db import response_cache_key
+from images import image_tokens
+from metrics import Trace
+from scheduler import INTERACTIVE, Abandoned, request_tokens, send
+
+MODEL = 'gpt-4o'
+
+
+# Raised when the model returns no answer text, which is never cached
+class EmptyAnswer(Exception):
+    pass
+
+
+# Function to build the messages of a vision request: the earlier turns, then the query with its images
+def build_messages(query, images, detail="auto", earlier=()):
+    return list(earlier) + [
+        {"role": "user", "content": [
+            {"type": "text", "text": query}
+        ] + [
+            {"type": "image_url", "image_url": {"url": image.url, "detail": detail}}
+            for image in images
+        ]}
+    ]
+
+
+# Function to answer a query about prepared images through the response cache.
+# Returns the answer text, or a generator of text chunks when stream is set and the cache misses.
+# Timings and token usage are added to trace; a streamed answer's are complete once the generator is exhausted.
+# With a scheduler, the request waits for the rate limits at the given priority, and callers asking the same
+# thing while it is in flight get its answer instead of making their own request
+def ask(client, cache, query, images, detail="auto", stream=False, use_cache=True, earlier=(), model=MODEL,
+        trace=None, scheduler=None, priority=INTERACTIVE):
+    trace = trace or Trace("query")
+    trace.model = model
+    image_hashes = [image.digest for image in images]
+    context = json.dumps(list(earlier)) if earlier else ""
+
+    if use_cache:
+        with trace.span("cache_read"):
+            cached = cache.get(model, query, image_hashes, detail, context)
+        if cached is not None:
+            trace.cached = True
+            return cached
+
+    key = response_cache_key(model, query, image_hashes, detail, context)
+    if scheduler is not None:
+        waited = time.perf_counter()
+        leader, text = scheduler.join(key)
+        if not leader:
+            trace.add_span("coalesced", time.perf_counter() - waited)
+            trace.cached = True
+            return text
+
+    def land(text=None, error=None):
+        if scheduler is not None:
+            scheduler.land(key, text, error)
+
+    tokens = sum(image_tokens(image.width, image.height, detail) for image in images)
+    trace.image_tokens += tokens
+    messages = build_messages(query, images, detail, earlier)
+    started = None
+
+    def request():
+        nonlocal started
+        started = time.perf_counter()
+        return client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.0,
+            stream=stream,
+            # Have the last chunk of a stream carry the token usage
+            **({"stream_options": {"include_usage": True}} if stream else {}),
+        )
+
+    def save(text):
+        if not text:
+            raise EmptyAnswer("The model returned an empty answer")
+        with trace.span("cache_write"):
+            cache.put(model, query, image_hashes, detail, text, context)
+        land(text)
+
+    # Whatever goes wrong before the answer is saved, the callers waiting on this request must be released
+    try:
+        response = send(scheduler, request, request_tokens(messages, tokens), priority, trace)
+        if not stream:
+            trace.add_span("api", time.perf_counter() - started)
+            trace.add_usage(response.usage)
+            resp = response.choices[0].message.content
+            save(resp)
+            return resp
+    except BaseException as e:
+        land(error=e if isinstance(e, Exception) else Abandoned())
+        raise
+
+    def streamed():
+        try:
+            # An empty stream raises EmptyAnswer like an empty blocking answer, and is not cached
+            yield from stream_text(response, save, trace, started)
+        finally:
+            # A stream that stops early has no answer for the callers waiting on it
+            land(error=Abandoned())
+    return streamed()
+
+
+# Function to yield the text of a streamed response as it arrives, passing the full text to on_complete at the end.
+# With a trace, records the time to the first token and to the end of the stream since started, and the usage
+def stream_text(response, on_complete=None, trace=None, started=None):
+    started = started or time.perf_counter()
+    parts = []
+    for chunk in response:
+        if trace is not None and chunk.usage:
+            trace.add_usage(chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            if trace is not None and not parts:
+                trace.add_span("first_token", time.perf_counter() - started)
+            parts.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+    if trace is not None:
+        trace.add_span("api", time.perf_counter() - started)
+    if on_complete is not None:
+        on_complete("".join(parts))